@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# Script to benchmark repoManager.py offline, against synthetic repositories
+# served locally with the wanted latency, bandwidth and missing files.
+
+import os, sys, time, shutil, random, gzip, bz2, lzma, argparse, threading, http.server, json, hashlib, subprocess, tempfile, functools
+
+RED='\033[0;31m'
+YEL='\033[0;33m'
+GRN='\033[0;32m'
+NOC='\033[0m' # No Color
+
+# Arguments checking
+argParser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+argParser.add_argument("-s", "--stanzas", action="store", default="10000", help="Default is 10000, Specify the packages of every repository, comma separated to run many sizes, ex. 1000,100000,500000.")
+argParser.add_argument("-r", "--repos", action="store", type=int, default=4, help="Default is 4, Specify how many repositories to serve.")
+argParser.add_argument("-f", "--formats", action="store", default="gz,bz2,xz,plain", help="Default is gz,bz2,xz,plain, Specify the Packages files every repository has, the first repository has the first one only,\nthe second the first two and so on.")
+argParser.add_argument("-mr", "--missing-release", action="store", type=int, default=1, help="Default is 1, Specify how many repositories have no Release file, so their Packages file is found by crawling.")
+argParser.add_argument("-l", "--latency", action="store", type=float, default=0, help="Default is 0, Specify the milliseconds the server waits before answering every request.")
+argParser.add_argument("-bw", "--bandwidth", action="store", default=None, help="Limit the speed of every connection of the server, in bytes per second, K and M suffixes allowed, ex. 2M.")
+argParser.add_argument("-nf", "--not-found-rate", action="store", type=float, default=0, help="Default is 0, Specify the fraction of the files answered with 404, always the same files for the same rate.")
+argParser.add_argument("-d", "--debs", action="store", type=int, default=20, help="Default is 20, Specify how many debs of every repository are wanted and downloaded.")
+argParser.add_argument("-ds", "--deb-size", action="store", type=int, default=65536, help="Default is 65536, Specify the size of every deb in bytes.")
+argParser.add_argument("-n", "--runs", action="store", type=int, default=1, help="Default is 1, Specify how many times to run every step, the fastest run is kept.")
+argParser.add_argument("-x", "--extra", action="store", default="", help="Specify arguments added to every repoManager.py run, ex. \"-j 4\".")
+argParser.add_argument("-o", "--output", action="store", default="benchmarkResults.jsonl", help="Default is benchmarkResults.jsonl, Specify the file the results are added to, one JSON line per size.")
+argParser.add_argument("-rm", "--repo-manager", action="store", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "repoManager.py"), help="Specify location of the repoManager.py to benchmark, default is the one next to this script.")
+argParser.add_argument("-k", "--keep", action="store_true", default=False, help="Keep the working directory of the repositories and the runs.")
+argParser.add_argument("-v", "--verbose", action="store_true", default=False, help="Increase output verbosity, print the output of the runs.")
+args = argParser.parse_args()
+
+try:
+	stanzasCounts = [int(stanzasCount) for stanzasCount in args.stanzas.split(',')]
+except ValueError:
+	stanzasCounts = []
+if not stanzasCounts or min(stanzasCounts) < 1:
+	print(RED+"Error"+NOC+": invalid stanzas")
+	exit()
+packagesFormats = [packagesFormat.strip() for packagesFormat in args.formats.split(',')]
+if not packagesFormats or any(packagesFormat not in ['gz', 'bz2', 'xz', 'plain'] for packagesFormat in packagesFormats):
+	print(RED+"Error"+NOC+": formats are gz, bz2, xz and plain")
+	exit()
+if args.repos < 1 or args.runs < 1 or args.debs < 0 or not 0 <= args.missing_release <= args.repos or not 0 <= args.not_found_rate < 1:
+	print(RED+"Error"+NOC+": invalid repositories, runs, debs, missing release or not found rate")
+	exit()
+if not os.path.isfile(args.repo_manager):
+	print(RED+"Error"+NOC+": "+args.repo_manager+" does NOT exists")
+	exit()
+if args.bandwidth != None:
+	rateMultipliers = {'K': 1024, 'M': 1048576}
+	try:
+		if args.bandwidth[-1:].upper() in rateMultipliers:
+			args.bandwidth = float(args.bandwidth[:-1])*rateMultipliers[args.bandwidth[-1:].upper()]
+		else:
+			args.bandwidth = float(args.bandwidth)
+	except ValueError:
+		args.bandwidth = 0
+	if args.bandwidth <= 0:
+		print(RED+"Error"+NOC+": invalid bandwidth")
+		exit()
+
+# Values of the synthetic packages
+sections = ['Tweaks', 'Themes', 'Utilities', 'System', 'Addons (SpringBoard)', 'Development', 'Networking', 'Widgets']
+maintainers = ['John Doe <john@example.com>', 'Jane Roe <jane@example.com>', 'Repo Team <team@example.com>']
+compressors = {'gz': ('.gz', lambda data: gzip.compress(data, 6, mtime=0)), 'bz2': ('.bz2', bz2.compress), 'xz': ('.xz', lzma.compress), 'plain': ('', lambda data: data)}
+
+# Served files are written in chunks of this size
+serveChunkSize = 16384
+
+# *********************** Generating the repositories
+
+# A deb of the synthetic repositories, random bytes are enough to download them
+def makeDeb(randomGenerator, size):
+	return b"!<arch>\n"+randomGenerator.getrandbits(8*size).to_bytes(size, 'little')
+
+# Write a repository of synthetic packages, its Packages files and maybe its Release file
+def generateRepo(repoDirectory, repoNumber, stanzasCount, formats, withRelease):
+	'''
+	the first packages have real debs, the others fake sizes and hashes
+	Returns the names of the packages having debs
+	'''
+	randomGenerator = random.Random(repoNumber*1000003+stanzasCount)
+	os.makedirs(os.path.join(repoDirectory, "debs"), exist_ok=True)
+	stanzas = []
+	debsPackages = []
+	for index in range(stanzasCount):
+		# a tenth of the packages are in every repository, in different versions
+		if index % 10 == 0:
+			packageName = "com.bench.shared.p{}".format(index)
+		else:
+			packageName = "com.bench.r{}.p{}".format(repoNumber, index)
+		version = "{}.{}-{}".format(randomGenerator.randint(0, 3), randomGenerator.randint(0, 20), repoNumber+1)
+		fileName = "debs/{}_{}_iphoneos-arm.deb".format(packageName, version)
+		if index < args.debs:
+			debData = makeDeb(randomGenerator, args.deb_size)
+			with open(os.path.join(repoDirectory, fileName), "wb") as fileObject:
+				fileObject.write(debData)
+			debSize, debMD5, debSHA256 = len(debData), hashlib.md5(debData).hexdigest(), hashlib.sha256(debData).hexdigest()
+			debsPackages.append(packageName)
+		else:
+			debSize, debMD5, debSHA256 = randomGenerator.randint(2000, 5000000), "{:032x}".format(randomGenerator.getrandbits(128)), "{:064x}".format(randomGenerator.getrandbits(256))
+		stanza = ["Package: "+packageName, "Name: Bench {} {}".format(repoNumber, index), "Version: "+version, "Architecture: iphoneos-arm",
+				"Maintainer: "+randomGenerator.choice(maintainers), "Author: "+randomGenerator.choice(maintainers), "Section: "+randomGenerator.choice(sections)]
+		if index % 3 == 0:
+			stanza.append("Depends: mobilesubstrate (>= 0.9.5000), com.bench.shared.p{} | firmware (>= 7.0)".format(randomGenerator.randrange(0, stanzasCount, 10)))
+		stanza += ["Filename: "+fileName, "Size: {}".format(debSize), "MD5sum: "+debMD5, "SHA256: "+debSHA256,
+				"Description: synthetic package {} of repository {}".format(index, repoNumber), " with a second line of description to parse",
+				"Depiction: https://example.com/depiction/{}".format(packageName), "Tag: purpose::extension, compatible::ios{}".format(randomGenerator.randint(9, 16))]
+		stanzas.append("\n".join(stanza))
+	packagesData = ("\n\n".join(stanzas)+"\n").encode()
+
+	releaseLines = ["Origin: Bench {}".format(repoNumber), "Label: Bench {}".format(repoNumber), "Suite: stable", "Architectures: iphoneos-arm", "Components: main"]
+	hashedFiles = []
+	for packagesFormat in formats:
+		fileExtension, compress = compressors[packagesFormat]
+		data = compress(packagesData)
+		with open(os.path.join(repoDirectory, "Packages"+fileExtension), "wb") as fileObject:
+			fileObject.write(data)
+		hashedFiles.append(("Packages"+fileExtension, data))
+	if withRelease:
+		for hashName, name in [('MD5Sum', 'md5'), ('SHA256', 'sha256')]:
+			releaseLines.append(hashName+":")
+			releaseLines += [" {} {:>16} {}".format(hashlib.new(name, data).hexdigest(), len(data), filePath) for filePath, data in hashedFiles]
+		with open(os.path.join(repoDirectory, "Release"), "w") as fileObject:
+			fileObject.write("\n".join(releaseLines)+"\n")
+	return debsPackages
+
+# *********************** Serving the repositories
+
+# Serves a repository slowly or with missing files, like the real ones
+class BenchmarkRequestHandler(http.server.SimpleHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def send_head(self):
+		if args.latency:
+			time.sleep(args.latency/1000)
+		if args.not_found_rate and int(hashlib.md5(self.path.encode()).hexdigest()[:8], 16)/0xffffffff < args.not_found_rate:
+			self.send_error(404)
+			return None
+		path = self.translate_path(self.path)
+		if not os.path.isfile(path):
+			return super().send_head()
+		fileStat = os.stat(path)
+		entityTag = '"{:x}-{:x}"'.format(fileStat.st_mtime_ns, fileStat.st_size)
+		if self.headers.get('If-None-Match') == entityTag:
+			self.send_response(304)
+			self.send_header("ETag", entityTag)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return None
+		fileObject = open(path, 'rb')
+		start = 0
+		rangeHeader = self.headers.get('Range', '')
+		if rangeHeader.startswith("bytes=") and rangeHeader[6:].split('-')[0].isdigit() and int(rangeHeader[6:].split('-')[0]) < fileStat.st_size:
+			start = int(rangeHeader[6:].split('-')[0])
+			fileObject.seek(start)
+			self.send_response(206)
+			self.send_header("Content-Range", "bytes {}-{}/{}".format(start, fileStat.st_size-1, fileStat.st_size))
+		else:
+			self.send_response(200)
+		self.send_header("Content-Type", "application/octet-stream")
+		self.send_header("Content-Length", str(fileStat.st_size-start))
+		self.send_header("ETag", entityTag)
+		self.end_headers()
+		return fileObject
+
+	def copyfile(self, source, outputfile):
+		startTime = time.time()
+		bytesWritten = 0
+		for block in iter(lambda: source.read(serveChunkSize), b''):
+			outputfile.write(block)
+			bytesWritten += len(block)
+			if args.bandwidth:
+				time.sleep(max(0, bytesWritten/args.bandwidth-(time.time()-startTime)))
+
+	def log_message(self, format, *formatArguments):
+		pass
+
+# A server not reporting the connections closed by the client, like a crawler giving up a download
+class BenchmarkServer(http.server.ThreadingHTTPServer):
+	daemon_threads = True
+
+	def handle_error(self, request, client_address):
+		if not isinstance(sys.exc_info()[1], ConnectionError):
+			super().handle_error(request, client_address)
+
+# Serve a directory on a free port of the local host
+def startServer(directory):
+	'''
+	Returns the server, its port is in server_address
+	'''
+	server = BenchmarkServer(('127.0.0.1', 0), functools.partial(BenchmarkRequestHandler, directory=directory))
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+# *********************** Running the benchmark
+
+# Run repoManager.py once in the working directory
+def runRepoManager(workDirectory, stepArguments):
+	'''
+	Returns the seconds it took and the phases of its metrics
+	'''
+	metricsPath = os.path.join(workDirectory, "metrics.json")
+	if os.path.isfile(metricsPath): os.remove(metricsPath)
+	command = [sys.executable, args.repo_manager, "-s", "sources.list", "-me", "metrics.json"]+stepArguments+args.extra.split()
+	startTime = time.perf_counter()
+	completedProcess = subprocess.run(command, cwd=workDirectory, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	seconds = time.perf_counter()-startTime
+	if args.verbose: print(completedProcess.stdout.decode('utf-8', 'replace'))
+	if completedProcess.returncode != 0:
+		print(RED+"Error"+NOC+": "+" ".join(command)+" failed\n"+completedProcess.stdout.decode('utf-8', 'replace')[-2000:])
+		exit()
+	phases = {}
+	if os.path.isfile(metricsPath):
+		with open(metricsPath) as fileObject:
+			phases = json.load(fileObject).get('phases', {})
+	return seconds, phases
+
+# Version of the benchmarked repoManager.py, its commit if it's in a git repository
+def getVersion():
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(args.repo_manager)),
+							stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return hashlib.sha256(open(args.repo_manager, 'rb').read()).hexdigest()[:12]
+
+# The last results of the same benchmark, to compare with
+def getPreviousResult(parameters):
+	previousResult = None
+	if os.path.isfile(args.output):
+		with open(args.output) as fileObject:
+			for lineInResults in fileObject:
+				try:
+					result = json.loads(lineInResults)
+				except ValueError:
+					continue
+				if result.get('parameters') == parameters:
+					previousResult = result
+	return previousResult
+
+# Steps of the benchmark, with the arguments of repoManager.py and what is removed before every run
+# every step goes on from the ones before it
+benchmarkSteps = [
+	('refresh', [], "tmpPackages"),
+	('refresh unchanged', [], None),
+	('wanted', ["-su", "-w", "wanted.txt"], None),
+	('build', ["-su", "-b"], None),
+	('download', ["-su", "-w", "wanted.txt", "-d", "debs"], "debs"),
+]
+
+version = getVersion()
+for stanzasCount in stanzasCounts:
+	workDirectory = tempfile.mkdtemp(prefix="repoBenchmark")
+	try:
+		startTime = time.time()
+		servers = []
+		sourcesLines = []
+		wantedPackages = []
+		for repoNumber in range(args.repos):
+			repoDirectory = os.path.join(workDirectory, "www", "repo{}".format(repoNumber))
+			withRelease = repoNumber >= args.missing_release
+			wantedPackages += generateRepo(repoDirectory, repoNumber, stanzasCount, packagesFormats[:repoNumber+1], withRelease)
+			server = startServer(repoDirectory)
+			servers.append(server)
+			sourcesLines.append("deb http://127.0.0.1:{}/ ./".format(server.server_address[1]))
+		with open(os.path.join(workDirectory, "sources.list"), "w") as fileObject:
+			fileObject.write("\n".join(sourcesLines)+"\n")
+		with open(os.path.join(workDirectory, "wanted.txt"), "w") as fileObject:
+			fileObject.write("\n".join(wantedPackages)+"\n")
+		print("[+++] Generated {}{}{} repositories of {}{}{} packages in {:.1f}s.".format(GRN, args.repos, NOC, GRN, stanzasCount, NOC, time.time()-startTime))
+
+		parameters = {'stanzas': stanzasCount, 'repos': args.repos, 'formats': packagesFormats, 'missingRelease': args.missing_release, 'latency': args.latency,
+					'bandwidth': args.bandwidth, 'notFoundRate': args.not_found_rate, 'debs': args.debs, 'debSize': args.deb_size, 'extra': args.extra}
+		previousResult = getPreviousResult(parameters)
+		steps = {}
+		for stepName, stepArguments, removedDirectory in benchmarkSteps:
+			bestSeconds, bestPhases = None, {}
+			for run in range(args.runs):
+				if removedDirectory != None and os.path.isdir(os.path.join(workDirectory, removedDirectory)):
+					shutil.rmtree(os.path.join(workDirectory, removedDirectory))
+				seconds, phases = runRepoManager(workDirectory, stepArguments)
+				if bestSeconds == None or seconds < bestSeconds:
+					bestSeconds, bestPhases = seconds, phases
+			steps[stepName] = {'seconds': bestSeconds, 'phases': bestPhases}
+			comparison = ""
+			if previousResult != None and stepName in previousResult.get('steps', {}):
+				previousSeconds = previousResult['steps'][stepName]['seconds']
+				change = (bestSeconds-previousSeconds)/max(previousSeconds, 0.000001)*100
+				comparison = " {}{:+.1f}%{} since {}".format(RED if change > 10 else GRN if change < -10 else YEL, change, NOC, previousResult['version'])
+			print("[+++] {:<20}{:>10.3f}s{}".format(stepName, bestSeconds, comparison))
+
+		with open(args.output, "a") as fileObject:
+			fileObject.write(json.dumps({'version': version, 'date': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), 'parameters': parameters, 'steps': steps}, sort_keys=True)+"\n")
+		for server in servers:
+			server.shutdown()
+	finally:
+		if args.keep:
+			print("[+++] Kept "+workDirectory)
+		else:
+			shutil.rmtree(workDirectory, ignore_errors=True)
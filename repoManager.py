@@ -2,7 +2,8 @@
 # Script to maintain a cydia repository, get packages from other repositories, 
 # set up a meta file and packages index.
 
-import os, time, shutil, binascii, random, gzip, bz2, argparse
+import os, sys, time, shutil, binascii, random, socket, mmap, tarfile, cProfile, pstats, gzip, bz2, lzma, argparse, threading, multiprocessing, atexit, http.client, http.server, urllib.parse, json, hashlib, zlib, re, io, contextlib, sqlite3, fnmatch, collections, functools, difflib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
 from urllib.request import *
 from urllib.error import *
 
@@ -26,12 +27,40 @@ NOC='\033[0m' # No Color
 # Arguments checking
 argParser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
 argParser.add_argument("-s", "--sources", action="store", help="Location of the sources file as it is in iDevice, check that :-)")
-argParser.add_argument("-w", "--wanted", action="store", default=None, help="If wanted to check for specific packages, Specify location of the wanted packages file, contents must be just packages names one per line.")
+argParser.add_argument("-w", "--wanted", action="store", default=None, help="If wanted to check for specific packages, Specify location of the wanted packages file, one per line:\n  packages names, globs like com.foo.*, re:regular expression of the whole name\n  and !name, !glob or !re:... to exclude, lines starting with # are comments.")
+argParser.add_argument("-wd", "--with-deps", action="store_true", default=False, help="Add the dependencies of the wanted packages, and theirs, choosing the newest version satisfying them.")
+argParser.add_argument("-nv", "--newest-only", action="store_true", default=False, help="Keep only the newest version of every package found in many repositories or Packages files.")
+argParser.add_argument("-rp", "--repo-priority", action="store", default=None, help="With newest only, comma separated domains of the prefered repositories first, ex. apt.thebigboss.org,repo.example.com\na package is taken from the most prefered repository having it, the newest version otherwise.")
 argParser.add_argument("-d", "--download", action="store", default=None, help="If wanted to download the deb files. Specify directory location to save the debs, it will take time depends on your link speed.")
+argParser.add_argument("-st", "--store", action="store", default=None, help="With download, Specify a directory to keep every deb once by its SHA256, linked to a directory of every repository in the download directory.")
+argParser.add_argument("-gc", "--store-gc", action="store_true", default=False, help="Remove the debs of the store which are in none of the Packages files.")
 argParser.add_argument("-dir", "--directory", action="store", default="tmpPackages", help="Default is tmpPackages, Specify a temporary directory to download all Release and Packages files to it.")
 argParser.add_argument("-b", "--build", action="store_true", default=False, help="Determine if wanted to build a Packages file from the results, if you're running a repository.")
+argParser.add_argument("-ri", "--release-info", action="store", default=None, help="With build, Specify location of a file of the Release fields of your repository, ex. Origin: and Label:, one per line.")
+argParser.add_argument("-bh", "--by-hash", action="store_true", default=False, help="With build, keep copies of the built Packages files by their hashes in by-hash directories too.")
+argParser.add_argument("-pd", "--pdiffs", action="store", type=int, default=0, help="With build, keep this many pdiffs of the changes between consecutive builds in Packages.diff, default is none.")
+argParser.add_argument("-q", "--search", action="store", default=None, help="Search the packages of all the sources for the words of the query, ex. \"dark keyboard\", words match the start of the words\n  of the Package, Name, Description, Author, Maintainer, Section and Tag fields, the best matches first.")
+argParser.add_argument("-ql", "--search-limit", action="store", type=int, default=25, help="Default is 25, Specify how many packages the search shows at most.")
+argParser.add_argument("-ch", "--changes", action="store", default=None, help="Save the packages added, upgraded, downgraded, changed and removed by the refresh to this file, as JSON if it ends with .json or as text.")
+argParser.add_argument("-oc", "--only-changes", action="store_true", default=False, help="Download and look for the wanted packages only among the packages added or changed by the refresh, the built Packages file still has all of them.")
+argParser.add_argument("-ni", "--no-index", action="store_true", default=False, help="Don't use the packages index of the temporary directory, parse all the Packages files every time.")
+argParser.add_argument("-bp", "--benchmark-parser", action="store_true", default=False, help="Time parsing all the Packages files with the stanza parser against the old line by line parser.")
+argParser.add_argument("-dm", "--daemon", action="store_true", default=False, help="Keep running, refresh every source on its own interval then find, build and download again if its Packages files changed.")
+argParser.add_argument("-in", "--interval", action="store", type=int, default=3600, help="Default is 3600, Specify the seconds between the refreshes of a source in daemon mode, every source varies it a bit.")
+argParser.add_argument("-po", "--port", action="store", type=int, default=8080, help="Default is 8080, Specify the port to serve the built repository in daemon mode, 0 to not serve it.")
+argParser.add_argument("-ad", "--address", action="store", default="127.0.0.1", help="Default is 127.0.0.1, Specify the address to serve the built repository on in daemon mode.")
+argParser.add_argument("-me", "--metrics", action="store", default=None, help="Specify a JSON file to save the timings and sizes of every phase, source and host to.")
+argParser.add_argument("-pm", "--prometheus", action="store", default=None, help="Specify a Prometheus textfile, ex. /var/lib/node_exporter/repoManager.prom, to save the same metrics to.")
+argParser.add_argument("-pr", "--profile", action="store_true", default=False, help="Profile the run with cProfile, print the slowest functions and save the stats to profile.pstats in the temporary directory.")
 argParser.add_argument("-v", "--verbose", action="store_true", default=False, help="Increase output verbosity.")
 argParser.add_argument("-su", "--skip-update", action="store_true", default=False, help="Skip updating sources.")
+argParser.add_argument("-j", "--jobs", action="store", type=int, default=1, help="Default is 1, Specify how many sources to refresh at the same time.")
+argParser.add_argument("-dj", "--download-jobs", action="store", type=int, default=4, help="Default is 4, Specify how many deb files to download at the same time.")
+argParser.add_argument("-r", "--retries", action="store", type=int, default=3, help="Default is 3, Specify how many times to retry a failed deb download.")
+argParser.add_argument("-lr", "--limit-rate", action="store", default=None, help="Limit the total download speed of deb files, in bytes per second, K and M suffixes allowed, ex. 500K.")
+argParser.add_argument("-pj", "--parse-jobs", action="store", type=int, default=1, help="Default is 1, Specify how many processes parse the Packages files, big files are split between them.")
+argParser.add_argument("-sd", "--scan-debs", action="store", default=None, help="Specify a directory of debs, ex. the download directory, to add their packages to the sources ones, as the local repository.\n  Only the new or changed debs are read again, by as many processes as the parse jobs.")
+argParser.add_argument("-hj", "--host-jobs", action="store", type=int, default=2, help="Default is 2, Specify how many sources of the same host to refresh at the same time.")
 args = argParser.parse_args()
 
 # initaiting and checking files and directories
@@ -42,7 +71,7 @@ for arg, argValue in vars(args).items():
 		print(RED+"Error"+NOC+": sources file is necessary\n")
 		argParser.print_usage()
 		exit()
-	if arg in ['download', 'directory']:
+	if arg in ['download', 'directory', 'store']:
 		if os.path.isdir(argValue):
 			if not os.access(argValue, os.W_OK):
 				print(RED+"Error"+NOC+": "+argValue+" is NOT writable")
@@ -58,7 +87,10 @@ for arg, argValue in vars(args).items():
 				else:
 					print(e.strerror)
 				exit()
-	if arg in ['sources', 'wanted']:
+	if arg == 'scan_debs' and not os.path.isdir(argValue):
+		print(RED+"Error"+NOC+": "+argValue+" is NOT a directory")
+		exit()
+	if arg in ['sources', 'wanted', 'release_info']:
 		if os.path.isfile(argValue):
 			if not os.access(argValue, os.R_OK):
 				print(RED+"Error"+NOC+": "+argValue+" is NOT readable")
@@ -67,14 +99,1334 @@ for arg, argValue in vars(args).items():
 			print(RED+"Error"+NOC+": "+argValue+" does NOT exists")
 			exit()
 
-# A dummy Exception for breaking nested loops
-class BreakMultipleLoops(Exception): pass
+if args.with_deps and not args.wanted:
+	print(RED+"Error"+NOC+": with dependencies needs a wanted packages file")
+	exit()
+if (args.release_info or args.by_hash or args.pdiffs) and not args.build:
+	print(RED+"Error"+NOC+": release info, by hash and pdiffs work with build")
+	exit()
+if args.daemon and (args.interval < 1 or not 0 <= args.port <= 65535):
+	print(RED+"Error"+NOC+": invalid daemon interval or port")
+	exit()
+if args.search != None and args.no_index:
+	print(RED+"Error"+NOC+": search works with the packages index")
+	exit()
+if (args.changes or args.only_changes) and args.no_index:
+	print(RED+"Error"+NOC+": changes work with the packages index")
+	exit()
+if args.search_limit < 1:
+	print(RED+"Error"+NOC+": search limit must be at least 1")
+	exit()
+if args.pdiffs < 0:
+	print(RED+"Error"+NOC+": pdiffs can NOT be negative")
+	exit()
+if args.store_gc and not args.store:
+	print(RED+"Error"+NOC+": store garbage collection needs a store")
+	exit()
+if args.repo_priority and not args.newest_only:
+	print(RED+"Error"+NOC+": repositories priority works with newest only")
+	exit()
+if args.jobs < 1 or args.host_jobs < 1 or args.download_jobs < 1 or args.parse_jobs < 1:
+	print(RED+"Error"+NOC+": jobs, host jobs, download jobs and parse jobs must be at least 1")
+	exit()
+if args.retries < 0:
+	print(RED+"Error"+NOC+": retries can NOT be negative")
+	exit()
+if args.limit_rate != None:
+	rateMultipliers = {'K': 1024, 'M': 1048576}
+	try:
+		if args.limit_rate[-1:].upper() in rateMultipliers:
+			args.limit_rate = float(args.limit_rate[:-1])*rateMultipliers[args.limit_rate[-1:].upper()]
+		else:
+			args.limit_rate = float(args.limit_rate)
+	except ValueError:
+		args.limit_rate = 0
+	if args.limit_rate <= 0:
+		print(RED+"Error"+NOC+": invalid limit rate")
+		exit()
+
+# State of the source being refreshed by the current thread
+# the source number for the [NNN] prefix and its buffered output if refreshing concurrently
+# and the error of the last request which got no response
+class SourceContext(threading.local):
+	countPadded = "+++"
+	outputLines = None
+	lastError = None
+
+sourceContext = SourceContext()
+outputLock = threading.Lock()
+
+# Limits how many sources of the same host are refreshed at the same time
+hostSemaphores = {}
+hostSemaphoresLock = threading.Lock()
+
+# Response of a pooled connection, gives the connection back to the pool
+# when closed after reading it all, behaves like the urlopen response
+class PooledResponse:
+	def __init__(self, pool, hostKey, connection, response, url, startTime=None, firstByteTime=None):
+		self.pool = pool
+		self.hostKey = hostKey
+		self.connection = connection
+		self.response = response
+		self.url = url
+		self.status = response.status
+		self.reason = response.reason
+		self.headers = response.headers
+		self.startTime = startTime or time.time()
+		self.firstByteTime = firstByteTime or self.startTime
+		self.bytesRead = 0
+
+	def read(self, amt=None):
+		data = self.response.read(amt)
+		self.bytesRead += len(data)
+		return data
+
+	def geturl(self):
+		return self.url
+
+	def close(self):
+		if self.connection == None:
+			return
+		metrics.addHost(self.hostKey[1], requests=1, firstByteSeconds=self.firstByteTime-self.startTime, totalSeconds=time.time()-self.startTime, bytes=self.bytesRead)
+		# an empty body (not modified) is complete without reading it
+		if not self.response.isclosed() and self.response.length == 0:
+			self.response.read()
+		# the connection is clean only if the whole body was read
+		if self.response.isclosed() and not self.response.will_close:
+			self.pool.releaseConnection(self.hostKey, self.connection)
+		else:
+			self.response.close()
+			self.connection.close()
+		self.connection = None
+
+# Persistent HTTP connections per host, saves TCP and TLS setup of every request to the same host
+class ConnectionPool:
+	redirectCodes = (301, 302, 303, 307, 308)
+	maxRedirects = 10
+	maxIdleSeconds = 60
+	# what a reused connection closed by the server meanwhile fails with
+	staleConnectionErrors = (http.client.BadStatusLine, ConnectionResetError, BrokenPipeError)
+	# the characters http.client refuses in a url path
+	invalidURLCharacters = re.compile('[\x00-\x20\x7f]')
+
+	def __init__(self, maxIdlePerHost):
+		self.maxIdlePerHost = maxIdlePerHost
+		self.idleConnections = {}
+		self.lock = threading.Lock()
+		self.openedConnections = 0
+		self.reusedConnections = 0
+
+	def getConnection(self, hostKey, timeout):
+		'''
+		Returns a tuple of an idle connection of the host or a new one and if it's reused
+		'''
+		with self.lock:
+			idleConnections = self.idleConnections.get(hostKey, [])
+			while idleConnections:
+				connection, lastUsed = idleConnections.pop()
+				if time.time()-lastUsed > self.maxIdleSeconds:
+					connection.close()
+					continue
+				self.reusedConnections += 1
+				connection.timeout = timeout
+				if connection.sock != None: connection.sock.settimeout(timeout)
+				return connection, True
+			self.openedConnections += 1
+
+		scheme, netloc = hostKey
+		if scheme == "https":
+			return http.client.HTTPSConnection(netloc, timeout=timeout), False
+		return http.client.HTTPConnection(netloc, timeout=timeout), False
+
+	def connect(self, hostKey, connection):
+		'''
+		connect a new connection, timing the name resolution apart from the TCP and TLS setup
+		'''
+		dnsSeconds = 0
+		def createConnection(address, timeout, sourceAddress=None):
+			nonlocal dnsSeconds
+			startTime = time.time()
+			addresses = socket.getaddrinfo(address[0], address[1], 0, socket.SOCK_STREAM)
+			dnsSeconds = time.time()-startTime
+			lastError = OSError("no address for "+address[0])
+			for family, socketType, protocol, canonicalName, socketAddress in addresses:
+				try:
+					return socket.create_connection(socketAddress[:2], timeout, sourceAddress)
+				except OSError as e:
+					lastError = e
+			raise lastError
+		connection._create_connection = createConnection
+		startTime = time.time()
+		connection.connect()
+		metrics.addHost(hostKey[1], dnsSeconds=dnsSeconds, connectSeconds=time.time()-startTime-dnsSeconds)
+
+	def releaseConnection(self, hostKey, connection):
+		with self.lock:
+			idleConnections = self.idleConnections.setdefault(hostKey, [])
+			if len(idleConnections) < self.maxIdlePerHost:
+				idleConnections.append((connection, time.time()))
+				return
+		connection.close()
+
+	def request(self, url, headers, timeout, method="GET"):
+		'''
+		Returns PooledResponse, follows redirects
+		raises HTTPError or URLError like urlopen
+		'''
+		for redirect in range(self.maxRedirects):
+			splittedURL = urllib.parse.urlsplit(url)
+			hostKey = (splittedURL.scheme, splittedURL.netloc)
+			path = splittedURL.path or "/"
+			if splittedURL.query: path += "?"+splittedURL.query
+			# a url http.client refuses fails the same on every connection
+			if self.invalidURLCharacters.search(path):
+				raise URLError(http.client.InvalidURL("URL can't contain control characters or spaces. {!r}".format(path)))
+
+			# an idle connection may be closed by the server meanwhile, then retry with a new one
+			while True:
+				connection, reused = self.getConnection(hostKey, timeout)
+				try:
+					if reused:
+						metrics.addHost(hostKey[1], reusedConnections=1)
+					else:
+						self.connect(hostKey, connection)
+					startTime = time.time()
+					connection.request(method, path, headers=headers)
+					response = connection.getresponse()
+					firstByteTime = time.time()
+				except (http.client.HTTPException, OSError) as e:
+					connection.close()
+					if reused and isinstance(e, self.staleConnectionErrors): continue
+					raise URLError(e)
+				break
+
+			pooledResponse = PooledResponse(self, hostKey, connection, response, url, startTime, firstByteTime)
+			if response.status in self.redirectCodes and "Location" in response.headers:
+				self.drain(pooledResponse)
+				url = urllib.parse.urljoin(url, response.headers["Location"])
+				continue
+			if response.status >= 400:
+				self.drain(pooledResponse)
+				raise HTTPError(url, response.status, response.reason, response.headers, None)
+			return pooledResponse
+		raise URLError("too many redirects")
+
+	# Read a small unwanted body so the connection can be reused
+	def drain(self, pooledResponse, maxSize=65536):
+		contentLength = pooledResponse.headers.get("Content-Length")
+		if contentLength != None and contentLength.isdigit() and int(contentLength) <= maxSize:
+			try:
+				pooledResponse.read()
+			except (http.client.HTTPException, OSError):
+				pass
+		pooledResponse.close()
+
+# Load a JSON file, default if it's not there or broken
+def loadJsonFile(path, default):
+	if os.path.isfile(path):
+		try:
+			with open(path) as fileObject:
+				return json.load(fileObject)
+		except (OSError, ValueError):
+			pass
+	return default
+
+# Save a JSON file by replacing it at once, so it's never found half written
+def saveJsonFile(path, data, indent=None):
+	temporaryPath = path+".tmp"
+	with open(temporaryPath, "w") as fileObject:
+		json.dump(data, fileObject, indent=indent, sort_keys=True)
+	os.replace(temporaryPath, path)
+
+# A state of the runs kept in a JSON file of the temporary directory, saved only if it changed
+class JsonStateFile:
+	def __init__(self, path, default):
+		self.path = path
+		self.lock = threading.Lock()
+		self.changed = False
+		self.state = loadJsonFile(path, default)
+
+	def save(self):
+		with self.lock:
+			if not self.changed:
+				return
+			saveJsonFile(self.path, self.state, indent="\t")
+			self.changed = False
+
+# Validators of the downloaded files by URL, saved in the temporary directory
+# so unchanged files cost one conditional request without body
+class MetadataCache(JsonStateFile):
+	def __init__(self, path):
+		super().__init__(path, {})
+
+	def getConditionalHeaders(self, url):
+		'''
+		Returns If-None-Match and If-Modified-Since headers if the local copy of url is intact
+		'''
+		with self.lock:
+			entry = self.state.get(url)
+		if entry == None or not os.path.isfile(entry['path']) or os.path.getsize(entry['path']) != entry['size']:
+			return {}
+		headers = {}
+		if entry.get('etag'): headers['If-None-Match'] = entry['etag']
+		if entry.get('lastModified'): headers['If-Modified-Since'] = entry['lastModified']
+		return headers
+
+	def update(self, url, path, response, size, sha256):
+		with self.lock:
+			self.state[url] = {
+				'path': path,
+				'etag': response.headers.get('ETag'),
+				'lastModified': response.headers.get('Last-Modified'),
+				'size': size,
+				'sha256': sha256,
+			}
+			self.changed = True
+
+# Health of every host, saved in the temporary directory
+# the timeout of a host follows its response time like the TCP retransmission timeout, doubled after every failure
+# and a host failing again and again is skipped for a while, the rest of the run most of the time
+class HostHealth(JsonStateFile):
+	minTimeout = 3
+	maxTimeout = 60
+	timeoutFactor = 2
+	failuresToSkip = 3
+	skipSeconds = 600
+
+	def __init__(self, path):
+		super().__init__(path, {})
+
+	def getEntry(self, host):
+		return self.state.setdefault(host, {'latency': None, 'deviation': 0, 'failures': 0, 'skippedUntil': 0})
+
+	def getTimeout(self, host):
+		with self.lock:
+			entry = self.getEntry(host)
+			timeout = self.minTimeout
+			if entry['latency'] != None:
+				timeout = max(timeout, self.timeoutFactor*(entry['latency']+4*entry['deviation']))
+			return min(self.maxTimeout, timeout*2**min(entry['failures'], self.failuresToSkip))
+
+	def isSkipped(self, host):
+		with self.lock:
+			return self.getEntry(host)['skippedUntil'] > time.time()
+
+	def addResponse(self, host, seconds):
+		'''
+		the host answered, even with an error status, after seconds
+		'''
+		with self.lock:
+			entry = self.getEntry(host)
+			if entry['latency'] == None:
+				entry['latency'] = seconds
+				entry['deviation'] = seconds/2
+			else:
+				entry['deviation'] += (abs(seconds-entry['latency'])-entry['deviation'])/4
+				entry['latency'] += (seconds-entry['latency'])/8
+			entry['failures'] = 0
+			entry['skippedUntil'] = 0
+			self.changed = True
+
+	def addFailure(self, host):
+		'''
+		the host didn't answer
+		Returns True if the host is skipped from now on
+		after being skipped a single failure skips it again
+		'''
+		with self.lock:
+			entry = self.getEntry(host)
+			entry['failures'] += 1
+			self.changed = True
+			if entry['failures'] >= self.failuresToSkip and entry['skippedUntil'] <= time.time():
+				entry['skippedUntil'] = time.time()+self.skipSeconds
+				return True
+			return False
+
+# Uncompress a compressed stream chunk by chunk, even concatenated streams
+class StreamDecompressor:
+	formats = ['.gz', '.bz2', '.xz', '.lzma']
+
+	def __init__(self, compressionFormat):
+		self.compressionFormat = compressionFormat
+		self.decompressor = self.newDecompressor()
+
+	def newDecompressor(self):
+		if self.compressionFormat == ".gz":
+			return zlib.decompressobj(16+zlib.MAX_WBITS)
+		if self.compressionFormat == ".xz":
+			return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+		if self.compressionFormat == ".lzma":
+			return lzma.LZMADecompressor(lzma.FORMAT_ALONE)
+		return bz2.BZ2Decompressor()
+
+	def decompress(self, data):
+		uncompressedBlocks = []
+		while data:
+			if self.decompressor.eof:
+				self.decompressor = self.newDecompressor()
+			uncompressedBlocks.append(self.decompressor.decompress(data))
+			data = self.decompressor.unused_data if self.decompressor.eof else b''
+		return b''.join(uncompressedBlocks)
+
+	def flush(self):
+		'''
+		Returns the rest of the uncompressed data, raises EOFError if the stream is truncated
+		'''
+		if not self.decompressor.eof:
+			raise EOFError("compressed stream is truncated")
+		return self.decompressor.flush() if self.compressionFormat == ".gz" else b''
+
+# Chooses which compressed Packages file to download, the one the least long to download and uncompress
+# from the speed of the link to the host and of every decompressor, measured and saved in the temporary directory
+class FormatSelector(JsonStateFile):
+	defaultLinkSpeed = 1048576
+	# compressed bytes uncompressed per second until measured
+	defaultDecompressionSpeeds = {'.gz': 50000000, '.bz2': 4000000, '.xz': 12000000, '.lzma': 12000000}
+	# smaller transfers are mostly latency, they tell nothing about the speed
+	minimumMeasuredSize = 65536
+
+	def __init__(self, path):
+		super().__init__(path, {})
+		self.state.setdefault('links', {})
+		self.state.setdefault('decompressors', {})
+
+	def addSpeed(self, kind, key, size, seconds):
+		if size < self.minimumMeasuredSize or seconds <= 0:
+			return
+		with self.lock:
+			speeds = self.state[kind]
+			speeds[key] = size/seconds if key not in speeds else speeds[key]+(size/seconds-speeds[key])/4
+			self.changed = True
+
+	def addTransfer(self, host, size, seconds):
+		self.addSpeed('links', host, size, seconds)
+
+	def addDecompression(self, compressionFormat, size, seconds):
+		self.addSpeed('decompressors', compressionFormat, size, seconds)
+
+	def getCost(self, host, fileName, size):
+		'''
+		Returns the seconds to download and uncompress a Packages file of this size
+		'''
+		compressionFormat = fileName[len('Packages'):]
+		with self.lock:
+			cost = size/self.state['links'].get(host, self.defaultLinkSpeed)
+			if compressionFormat:
+				cost += size/self.state['decompressors'].get(compressionFormat, self.defaultDecompressionSpeeds.get(compressionFormat, self.defaultLinkSpeed))
+		return cost
+
+	def choose(self, host, sizesByFileName):
+		'''
+		sizesByFileName is a list of tuples of Packages file names in the prefered order and their size
+		the size is 0 if the local copy is up to date, None if unknown
+		Returns the file name of the least cost, the first one if no size is known
+		'''
+		costs = [(self.getCost(host, fileName, size), position, fileName) for position, (fileName, size) in enumerate(sizesByFileName) if size != None]
+		if not costs:
+			return sizesByFileName[0][0]
+		return min(costs)[2]
+
+# Decides if a package is wanted by the wanted packages file, names are looked up in sets
+# and all the globs and regular expressions are compiled into one regular expression
+class WantedMatcher:
+	def __init__(self, lines):
+		self.entries = []
+		self.exactNames = {}
+		self.excludedNames = set()
+		self.matchedEntries = set()
+		includePatterns = []
+		excludePatterns = []
+		# regular expressions are compiled one by one, their flags, group names and back references are their own
+		self.includeExpressions = []
+		self.excludeExpressions = []
+		for line in lines:
+			entry = line.strip()
+			if not entry or entry.startswith('#'):
+				continue
+			excluded = entry.startswith('!')
+			pattern = entry[1:].strip() if excluded else entry
+			if pattern.startswith('re:'):
+				try:
+					compiledExpression = re.compile(pattern[3:])
+				except re.error as e:
+					print(getAlignedLine("[+++] invalid wanted regular expression "+pattern+", "+str(e), "ERROR"))
+					continue
+				if excluded:
+					self.excludeExpressions.append(compiledExpression)
+				else:
+					self.entries.append(entry)
+					self.includeExpressions.append((compiledExpression, entry))
+				continue
+			if any(character in pattern for character in '*?['):
+				regularExpression = fnmatch.translate(pattern)
+			else:
+				regularExpression = None
+
+			if excluded:
+				if regularExpression == None: self.excludedNames.add(pattern)
+				else: excludePatterns.append("(?:{})".format(regularExpression))
+				continue
+			self.entries.append(entry)
+			if regularExpression == None:
+				self.exactNames.setdefault(pattern, entry)
+			else:
+				# the group name tells which entry matched
+				includePatterns.append("(?P<e{}>{})".format(len(self.entries)-1, regularExpression))
+		self.includePattern = re.compile("|".join(includePatterns)) if includePatterns else None
+		self.excludePattern = re.compile("|".join(excludePatterns)) if excludePatterns else None
+
+	def hasPatterns(self):
+		return self.includePattern != None or bool(self.includeExpressions)
+
+	def matches(self, packageName):
+		if packageName == None or packageName in self.excludedNames:
+			return False
+		if self.excludePattern != None and self.excludePattern.fullmatch(packageName):
+			return False
+		if any(compiledExpression.fullmatch(packageName) for compiledExpression in self.excludeExpressions):
+			return False
+		if packageName in self.exactNames:
+			self.matchedEntries.add(self.exactNames[packageName])
+			return True
+		if self.includePattern != None:
+			match = self.includePattern.fullmatch(packageName)
+			if match:
+				self.matchedEntries.add(self.entries[int(match.lastgroup[1:])])
+				return True
+		for compiledExpression, entry in self.includeExpressions:
+			if compiledExpression.fullmatch(packageName):
+				self.matchedEntries.add(entry)
+				return True
+		return False
+
+	def getUnmatchedEntries(self):
+		return [entry for entry in self.entries if entry not in self.matchedEntries]
+
+# Resolves the dependencies of packages over all the Packages files, by name and by what packages provide
+class DependencyResolver:
+	dependencyFields = ['Pre-Depends', 'Depends']
+	neededFields = ['Package', 'Version', 'Provides', 'Pre-Depends', 'Depends']
+	# provided by the iDevice itself, not by repositories
+	devicePackages = ['firmware']
+	devicePackagesPrefixes = ('cy+', 'gsc.')
+
+	def __init__(self, packages):
+		'''
+		packages are tuples of the Packages file, the offset and the fields of every package
+		'''
+		self.packages = {}
+		self.packagesByName = {}
+		self.packagesByProvides = {}
+		for packagesFile, offset, packageInfo in packages:
+			if 'Package' not in packageInfo:
+				continue
+			packageKey = (packagesFile, offset)
+			self.packages[packageKey] = packageInfo
+			self.packagesByName.setdefault(packageInfo['Package'], []).append(packageKey)
+			for relation in parseRelations(packageInfo.get('Provides', '')):
+				for providedName, operator, providedVersion in relation:
+					self.packagesByProvides.setdefault(providedName, []).append((packageKey, providedVersion))
+
+	def getCandidates(self, name, operator, version):
+		'''
+		Returns the keys of the packages satisfying a dependency on name with an optional version constraint
+		'''
+		candidates = [packageKey for packageKey in self.packagesByName.get(name, [])
+						if operator == None or versionSatisfies(self.packages[packageKey].get('Version', ''), operator, version)]
+		# only versioned provides can satisfy a versioned dependency
+		for packageKey, providedVersion in self.packagesByProvides.get(name, []):
+			if operator == None or (providedVersion != None and versionSatisfies(providedVersion, operator, version)):
+				candidates.append(packageKey)
+		return candidates
+
+	def isDevicePackage(self, name):
+		return name in self.devicePackages or name.startswith(self.devicePackagesPrefixes)
+
+	def resolve(self, rootKeys):
+		'''
+		Returns a tuple of the keys of the dependencies not in rootKeys
+		and a list of the unresolved dependencies as tuples of the package name and the dependency
+		'''
+		selectedKeys = set(rootKeys)
+		queue = collections.deque(rootKeys)
+		unresolvedDependencies = []
+		while queue:
+			packageInfo = self.packages[queue.popleft()]
+			for field in self.dependencyFields:
+				for relation in parseRelations(packageInfo.get(field, '')):
+					# already satisfied by a selected package or the device
+					if any(self.isDevicePackage(name) or any(candidate in selectedKeys for candidate in self.getCandidates(name, operator, version))
+							for name, operator, version in relation):
+						continue
+					# the first alternative which can be satisfied, by its newest version
+					for name, operator, version in relation:
+						candidates = self.getCandidates(name, operator, version)
+						if candidates:
+							chosenKey = max(candidates, key=functools.cmp_to_key(lambda first, second: compareVersions(self.packages[first].get('Version', ''), self.packages[second].get('Version', ''))))
+							selectedKeys.add(chosenKey)
+							queue.append(chosenKey)
+							break
+					else:
+						unresolvedDependencies.append((packageInfo['Package'], formatRelation(relation)))
+		return selectedKeys-set(rootKeys), unresolvedDependencies
+
+# Parses the Packages files in a pool of processes, a big file is split into parts between packages
+# the results are given back in the order of the files and of the packages in them, the same as parsing them one by one
+class PackagesParser:
+	def __init__(self, jobs):
+		# the parse jobs are forked, this script can NOT be imported again by a new process
+		if 'fork' not in multiprocessing.get_all_start_methods():
+			jobs = 1
+		self.jobs = jobs
+		# the results of only a few files wait for their turn, the others are submitted as these are read
+		self.windowSize = jobs*2
+		self.executor = None
+		self.pendingParts = {}
+		self.queuedFiles = collections.deque()
+
+	def getExecutor(self):
+		if self.executor == None:
+			self.executor = ProcessPoolExecutor(max_workers=self.jobs, mp_context=multiprocessing.get_context('fork'))
+		return self.executor
+
+	def submit(self, path, function, **options):
+		'''
+		returns a list of the futures of every part of the file
+		'''
+		self.getExecutor()
+		partsCount = min(self.jobs, max(1, os.path.getsize(path)//parsePartSize))
+		return [self.executor.submit(parsePart, function, path, start, end, options) for start, end in getStanzaRanges(path, partsCount)]
+
+	def prefetch(self, packagesFiles):
+		'''
+		start parsing the Packages files, parse() gives the results when they are needed
+		'''
+		if self.jobs == 1:
+			return
+		self.queuedFiles.extend(packagesFiles)
+		self.fillWindow()
+
+	def fillWindow(self):
+		while self.queuedFiles and len(self.pendingParts) < self.windowSize:
+			packagesFile = self.queuedFiles.popleft()
+			if packagesFile not in self.pendingParts:
+				self.pendingParts[packagesFile] = self.submit(packagesFile, locateStanzas)
+
+	def parse(self, packagesFile):
+		'''
+		yields the same tuples as locateStanzas
+		'''
+		if self.jobs == 1:
+			yield from locateStanzas(packagesFile)
+			return
+		futures = self.pendingParts.pop(packagesFile, None)
+		if futures == None:
+			if packagesFile in self.queuedFiles: self.queuedFiles.remove(packagesFile)
+			futures = self.submit(packagesFile, locateStanzas)
+		self.fillWindow()
+		for future in futures:
+			yield from future.result()
+
+	def getAllPackages(self, packagesFiles):
+		'''
+		yields a tuple of the Packages file, the offset and the fields of every package, like PackagesIndex.getAllPackages
+		'''
+		self.prefetch(packagesFiles)
+		for packagesFile in packagesFiles:
+			for packageInfo, offset, length in self.parse(packagesFile):
+				yield packagesFile, offset, packageInfo
+
+	def map(self, function, items):
+		'''
+		yields the result of function for every item in their order
+		'''
+		if self.jobs == 1:
+			for item in items:
+				yield function(item)
+			return
+		yield from self.getExecutor().map(function, items, chunksize=8)
+
+	def getIndexRows(self, packagesFiles, fields):
+		'''
+		yields the rows to index of every Packages file, a list of the offset, the length and the fields of every package
+		'''
+		if self.jobs == 1:
+			for packagesFile in packagesFiles:
+				yield getIndexRows(packagesFile, fields)
+			return
+		queuedFiles = collections.deque(packagesFiles)
+		futuresOfFiles = collections.deque()
+		while queuedFiles or futuresOfFiles:
+			while queuedFiles and len(futuresOfFiles) < self.windowSize:
+				futuresOfFiles.append(self.submit(queuedFiles.popleft(), getIndexRows, fields=fields))
+			yield [row for future in futuresOfFiles.popleft() for row in future.result()]
+
+# Persistent index of the packages of all the Packages files, saved in the temporary directory
+# only Packages files with a changed content are parsed again
+class PackagesIndex:
+	indexedFields = ['Package', 'Version', 'Architecture', 'Section', 'Maintainer', 'Filename', 'Size', 'MD5Sum', 'SHA256',
+					'Depends', 'Pre-Depends', 'Provides', 'Conflicts', 'Breaks']
+	# the full text index of the search, a match in the name of a package weighs more than in its description
+	searchedFields = ['Package', 'Name', 'Description', 'Author', 'Maintainer', 'Section', 'Tag']
+	searchWeights = [10.0, 8.0, 2.0, 1.0, 1.0, 1.0, 1.0]
+
+	def __init__(self, path):
+		self.connection = sqlite3.connect(path)
+		self.connection.row_factory = sqlite3.Row
+		self.columns = ", ".join('"{}"'.format(field) for field in self.indexedFields)
+		# the fields read from the Packages files, the indexed ones then the searched ones which aren't indexed
+		self.parsedFields = self.indexedFields+[field for field in self.searchedFields if field not in self.indexedFields]
+		with self.connection:
+			self.connection.execute("CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime REAL, sha256 TEXT)")
+			self.connection.execute("CREATE TABLE IF NOT EXISTS packages (fileId INTEGER, position INTEGER, offset INTEGER, length INTEGER, stanzaHash TEXT, {})".format(
+				", ".join('"{}" TEXT'.format(field) for field in self.indexedFields)))
+			# the hash of every package tells the changes of a Packages file, the packages indexed before have none
+			if 'stanzaHash' not in [column['name'] for column in self.connection.execute("PRAGMA table_info(packages)")]:
+				self.connection.execute("ALTER TABLE packages ADD COLUMN stanzaHash TEXT")
+			self.connection.execute("CREATE INDEX IF NOT EXISTS packagesByFile ON packages (fileId, position)")
+			self.connection.execute('CREATE INDEX IF NOT EXISTS packagesByName ON packages ("Package", fileId)')
+			self.connection.execute("CREATE INDEX IF NOT EXISTS packagesByOffset ON packages (fileId, offset)")
+			# the rowid of a package in packagesText is its rowid in packages
+			if self.connection.execute("SELECT name FROM sqlite_master WHERE name = 'packagesText'").fetchone() == None:
+				self.connection.execute("CREATE VIRTUAL TABLE packagesText USING fts5({}, prefix='2 3')".format(
+					", ".join('"{}"'.format(field) for field in self.searchedFields)))
+				# the Packages files indexed without it are indexed again
+				self.connection.execute("DELETE FROM packages")
+				self.connection.execute("DELETE FROM files")
+		self.connection.execute("CREATE TEMPORARY TABLE wanted (name TEXT PRIMARY KEY)")
+		self.connection.execute("CREATE TEMPORARY TABLE dependencies (fileId INTEGER, offset INTEGER)")
+		self.changes = []
+
+	def update(self, packagesFiles):
+		'''
+		index the Packages files which are new or changed, the changes of their packages are kept in changes
+		Returns a list of the re-indexed Packages files
+		'''
+		updatedFiles = []
+		changedFiles = []
+		self.changes = []
+		# the sources of the same domain share their Packages files
+		for packagesFile in dict.fromkeys(packagesFiles):
+			fileStat = os.stat(packagesFile)
+			fileRow = self.connection.execute("SELECT * FROM files WHERE path = ?", (packagesFile,)).fetchone()
+			if fileRow != None and fileRow['size'] == fileStat.st_size and fileRow['mtime'] == fileStat.st_mtime:
+				continue
+			contentHash = getFileHash(packagesFile)
+			if fileRow != None and fileRow['sha256'] == contentHash:
+				with self.connection:
+					self.connection.execute("UPDATE files SET size = ?, mtime = ? WHERE id = ?", (fileStat.st_size, fileStat.st_mtime, fileRow['id']))
+				continue
+			changedFiles.append((packagesFile, fileStat, fileRow, contentHash))
+
+		# the changed files are parsed at the same time by the parse jobs, and indexed one by one in their order
+		indexRows = packagesParser.getIndexRows([packagesFile for packagesFile, fileStat, fileRow, contentHash in changedFiles], self.parsedFields)
+		searchedColumns = [3+self.parsedFields.index(field) for field in self.searchedFields]
+		digestColumns = [3+self.parsedFields.index(field) for field in ['Package', 'Architecture', 'Version']]+[2, 0]
+		for (packagesFile, fileStat, fileRow, contentHash), rowsOfThisFile in zip(changedFiles, indexRows):
+			startTime = time.time()
+			with self.connection:
+				oldDigest = {}
+				if fileRow == None:
+					fileId = self.connection.execute("INSERT INTO files (path) VALUES (?)", (packagesFile,)).lastrowid
+				else:
+					fileId = fileRow['id']
+					oldDigest = self.getDigest(fileId)
+					self.deletePackages(fileId)
+				firstRowId = self.connection.execute("SELECT IFNULL(MAX(rowid), 0)+1 FROM packages").fetchone()[0]
+				rowsOfThisFile = list(rowsOfThisFile)
+				self.connection.executemany("INSERT INTO packages (rowid, fileId, position, offset, length, stanzaHash, {}) VALUES (?, ?, ?, ?, ?, ?, {})".format(
+					self.columns, ", ".join("?"*len(self.indexedFields))),
+					([firstRowId+position, fileId, position]+row[:3+len(self.indexedFields)] for position, row in enumerate(rowsOfThisFile)))
+				self.connection.executemany("INSERT INTO packagesText (rowid, {}) VALUES (?, {})".format(
+					", ".join('"{}"'.format(field) for field in self.searchedFields), ", ".join("?"*len(self.searchedFields))),
+					([firstRowId+position]+[row[column] for column in searchedColumns] for position, row in enumerate(rowsOfThisFile)))
+				self.connection.execute("UPDATE files SET size = ?, mtime = ?, sha256 = ? WHERE id = ?", (fileStat.st_size, fileStat.st_mtime, contentHash, fileId))
+			newDigest = getPackagesDigest([row[column] for column in digestColumns] for row in rowsOfThisFile)
+			self.changes += getPackagesChanges(packagesFile, oldDigest, newDigest)
+			metrics.addSource(os.path.basename(packagesFile).split('_')[0], parseSeconds=time.time()-startTime)
+			updatedFiles.append(packagesFile)
+
+		# forget the Packages files which don't exist anymore
+		with self.connection:
+			for fileRow in self.connection.execute("SELECT id, path FROM files").fetchall():
+				if not os.path.isfile(fileRow['path']):
+					self.changes += getPackagesChanges(fileRow['path'], self.getDigest(fileRow['id']), {})
+					self.deletePackages(fileRow['id'])
+					self.connection.execute("DELETE FROM files WHERE id = ?", (fileRow['id'],))
+		return updatedFiles
+
+	def getDigest(self, fileId):
+		cursor = self.connection.cursor()
+		cursor.row_factory = None
+		return getPackagesDigest(cursor.execute('SELECT "Package", "Architecture", "Version", stanzaHash, offset FROM packages WHERE fileId = ?', (fileId,)))
+
+	def deletePackages(self, fileId):
+		self.connection.execute("DELETE FROM packagesText WHERE rowid IN (SELECT rowid FROM packages WHERE fileId = ?)", (fileId,))
+		self.connection.execute("DELETE FROM packages WHERE fileId = ?", (fileId,))
+
+	def search(self, query, packagesFiles, limit):
+		'''
+		returns a list of the best matching packages of the Packages files, as rows of Package, Version, Filename and path
+		every word of the query has to match the start of a word of one of the searched fields
+		'''
+		words = ['"{}"*'.format(word.replace('"', '""')) for word in query.split()]
+		if not words:
+			return []
+		return self.connection.execute('SELECT packages."Package", packages."Version", packages."Filename", files.path FROM packagesText '
+			"JOIN packages ON packages.rowid = packagesText.rowid JOIN files ON files.id = packages.fileId "
+			"WHERE packagesText MATCH ? AND files.path IN (SELECT value FROM json_each(?)) "
+			"ORDER BY bm25(packagesText, {}) LIMIT ?".format(", ".join(str(weight) for weight in self.searchWeights)),
+			(" ".join(words), json.dumps(packagesFiles), limit)).fetchall()
+
+	def getPackagesNames(self):
+		return [row[0] for row in self.connection.execute('SELECT DISTINCT "Package" FROM packages')]
+
+	def setWanted(self, packagesNames):
+		with self.connection:
+			self.connection.execute("DELETE FROM wanted")
+			self.connection.executemany("INSERT OR IGNORE INTO wanted VALUES (?)", ((packageName,) for packageName in packagesNames))
+
+	def setDependencies(self, packagesKeys):
+		'''
+		packagesKeys are tuples of a Packages file and the offset of a package in it
+		'''
+		filesIds = {row['path']: row['id'] for row in self.connection.execute("SELECT id, path FROM files")}
+		with self.connection:
+			self.connection.execute("DELETE FROM dependencies")
+			self.connection.executemany("INSERT INTO dependencies VALUES (?, ?)", ((filesIds[packagesFile], offset) for packagesFile, offset in packagesKeys if packagesFile in filesIds))
+
+	def getAllPackages(self, packagesFiles, fields):
+		'''
+		yields a tuple of the Packages file, the offset and a dictonary of some indexed fields of every package
+		in the order of the Packages files
+		'''
+		filesIds = {row['path']: row['id'] for row in self.connection.execute("SELECT id, path FROM files")}
+		query = "SELECT offset, {} FROM packages WHERE fileId = ? ORDER BY position".format(", ".join('"{}"'.format(field) for field in fields))
+		for packagesFile in packagesFiles:
+			if packagesFile not in filesIds:
+				continue
+			cursor = self.connection.cursor()
+			cursor.row_factory = None
+			for row in cursor.execute(query, (filesIds[packagesFile],)):
+				yield packagesFile, row[0], {field: value for field, value in zip(fields, row[1:]) if value != None}
+
+	def getPackages(self, packagesFile, onlyWanted=False):
+		'''
+		yields a tuple of a dictonary of the indexed fields of a package, its offset and its length
+		in the order of the Packages file, only the packages in the wanted or dependencies tables if onlyWanted
+		'''
+		fileRow = self.connection.execute("SELECT id FROM files WHERE path = ?", (packagesFile,)).fetchone()
+		if fileRow == None:
+			return
+		if onlyWanted:
+			rows = self.connection.execute("SELECT packages.* FROM wanted JOIN packages ON packages.\"Package\" = wanted.name WHERE fileId = ? "
+				"UNION SELECT packages.* FROM dependencies JOIN packages ON packages.fileId = dependencies.fileId AND packages.offset = dependencies.offset WHERE dependencies.fileId = ? "
+				"ORDER BY position", (fileRow['id'], fileRow['id']))
+		else:
+			rows = self.connection.execute("SELECT * FROM packages WHERE fileId = ? ORDER BY position", (fileRow['id'],))
+		for row in rows:
+			yield {field: row[field] for field in self.indexedFields if row[field] != None}, row['offset'], row['length']
+
+# Shared bandwidth limit of many threads, a token bucket of one second
+class RateLimiter:
+	def __init__(self, bytesPerSecond):
+		self.bytesPerSecond = bytesPerSecond
+		self.lock = threading.Lock()
+		self.nextAllowedTime = time.time()
+
+	def consume(self, size):
+		with self.lock:
+			now = time.time()
+			# don't let an idle period give more than one second of burst
+			self.nextAllowedTime = max(self.nextAllowedTime, now-1)+size/self.bytesPerSecond
+			waitTime = self.nextAllowedTime-now
+		if waitTime > 0:
+			time.sleep(waitTime)
+
+# Downloads deb files with a pool of workers while the Packages files are still being processed
+# partial files are resumed, failures retried and every deb verified against its Packages entry
+class DebDownloadQueue:
+	backoffSeconds = 1
+	checksumFields = {'MD5Sum': 'md5', 'SHA256': 'sha256'}
+
+	def __init__(self, jobs, retries, rateLimit, storeDirectory=None):
+		self.executor = ThreadPoolExecutor(max_workers=jobs)
+		self.retries = retries
+		self.rateLimiter = RateLimiter(rateLimit) if rateLimit else None
+		self.storeDirectory = storeDirectory
+		self.storeLocks = collections.defaultdict(threading.Lock)
+		self.futures = []
+		self.queuedPaths = set()
+		self.lock = threading.Lock()
+		self.results = {'downloaded': 0, 'linked': 0, 'exists': 0, 'failed': 0}
+
+	def add(self, url, downloadDirectory, expected):
+		'''
+		queue a deb url, expected is a dictonary of its Size, MD5Sum and SHA256 if known
+		with a store every repository has its own directory, debs of the same SHA256 are downloaded once
+		'''
+		if self.storeDirectory != None:
+			downloadDirectory = os.path.join(downloadDirectory, url.split('/')[2])
+		localFilePath = os.path.join(downloadDirectory, getDebFileName(url))
+		if localFilePath in self.queuedPaths:
+			return
+		self.queuedPaths.add(localFilePath)
+		self.futures.append(self.executor.submit(self.download, url, localFilePath, expected))
+
+	def wait(self):
+		wait(self.futures)
+		self.executor.shutdown()
+		printOutput("[+++] Debs: {}{}{} downloaded, {}{}{} linked from the store, {}{}{} already exist, {}{}{} failed.".format(GRN, self.results['downloaded'], NOC,
+					GRN, self.results['linked'], NOC, GRN, self.results['exists'], NOC, RED if self.results['failed'] else GRN, self.results['failed'], NOC))
+
+	def addResult(self, result):
+		with self.lock:
+			self.results[result] += 1
+
+	def download(self, url, localFilePath, expected):
+		storePath = getStorePath(self.storeDirectory, expected['SHA256']) if self.storeDirectory != None and 'SHA256' in expected else None
+		if storePath == None:
+			self.downloadOrLink(url, localFilePath, expected, None)
+			return
+		# the same deb of other repositories waits for this one, then it's linked
+		with self.lock:
+			storeLock = self.storeLocks[storePath]
+		with storeLock:
+			self.downloadOrLink(url, localFilePath, expected, storePath)
+
+	def downloadOrLink(self, url, localFilePath, expected, storePath):
+		'''
+		link the deb from the store if it's there, or download it then keep it in the store
+		'''
+		domainName = url.split('/')[2]
+		fileName = os.path.basename(localFilePath)
+		try:
+			if storePath != None and os.path.isfile(storePath) and ('Size' not in expected or os.path.getsize(storePath) == expected['Size']):
+				if os.path.isfile(localFilePath) and os.path.samefile(storePath, localFilePath):
+					if args.verbose: printOutput(getAlignedLine("[+++] "+fileName+" already exists", "FOUND", GRN))
+					self.addResult('exists')
+				else:
+					os.makedirs(os.path.dirname(localFilePath), exist_ok=True)
+					linkFile(storePath, localFilePath)
+					if args.verbose: printOutput(getAlignedLine("[+++] "+domainName+" "+fileName+" linked from the store", "FOUND", GRN))
+					self.addResult('linked')
+				return
+			os.makedirs(os.path.dirname(localFilePath), exist_ok=True)
+			if os.path.isfile(localFilePath) and self.verify(localFilePath, expected, checkHashes=True):
+				if storePath != None: self.addToStore(localFilePath, storePath)
+				if args.verbose: printOutput(getAlignedLine("[+++] "+fileName+" already exists", "FOUND", GRN))
+				self.addResult('exists')
+				return
+			# a local deb not matching its entry is broken, don't let it be reported as not modified
+			if os.path.isfile(localFilePath) and expected:
+				os.remove(localFilePath)
+
+			for attempt in range(self.retries+1):
+				if attempt:
+					time.sleep(self.backoffSeconds*2**(attempt-1)+random.random())
+				with getHostSemaphore(domainName):
+					result = self.downloadOnce(url, localFilePath, expected)
+				if result:
+					if storePath != None: self.addToStore(localFilePath, storePath)
+					if args.verbose: printOutput(getAlignedLine("[+++] "+domainName+" "+fileName+" "+result, "SUCCESS", GRN))
+					self.addResult('downloaded')
+					return
+			printOutput(getAlignedLine("[+++] "+domainName+" "+fileName+" can NOT be downloaded", "FAILED"))
+		except Exception as e:
+			printOutput(getAlignedLine("[+++] "+domainName+" "+fileName+" "+str(e), "FAILED"))
+		self.addResult('failed')
+
+	def downloadOnce(self, url, localFilePath, expected):
+		'''
+		download or resume a deb once
+		Returns the link speed on success or None, raises the error of the request if retrying won't help
+		'''
+		partialFilePath = localFilePath+".part"
+		partialSize = os.path.getsize(partialFilePath) if os.path.isfile(partialFilePath) else 0
+		if 'Size' in expected and partialSize >= expected['Size']:
+			partialSize = 0
+
+		sourceContext.lastError = None
+		response = getResponse(url, {'Range': 'bytes={}-'.format(partialSize)} if partialSize else None)
+		if response == None:
+			# the partial file may be the reason, start from zero next time
+			if partialSize: os.remove(partialFilePath)
+			# retrying won't help, unless it was for the rest of the partial file
+			if not partialSize and sourceContext.lastError != None and not isTransientError(sourceContext.lastError):
+				raise sourceContext.lastError
+			return None
+		if response.status == 304:
+			response.close()
+			# with nothing to check the local deb against, the server's word is taken
+			if not expected:
+				return "not modified" if os.path.isfile(localFilePath) else None
+			return "not modified" if self.verify(localFilePath, expected, checkHashes=True) else None
+
+		# resuming only if the server sends the rest, otherwise start from zero
+		hashes = {name: hashlib.new(name) for name in self.checksumFields.values()}
+		if response.status == 206 and response.headers.get('Content-Range', '').startswith("bytes {}-".format(partialSize)):
+			with open(partialFilePath, "rb") as fileObject:
+				for block in iter(lambda: fileObject.read(downloadChunkSize), b''):
+					for contentHash in hashes.values(): contentHash.update(block)
+			mode = "ab"
+		else:
+			partialSize = 0
+			mode = "wb"
+
+		bytesRead = partialSize
+		startTime = time.time()
+		try:
+			with open(partialFilePath, mode) as fileObject:
+				while True:
+					block = response.read(downloadChunkSize)
+					if not block:
+						break
+					if self.rateLimiter != None: self.rateLimiter.consume(len(block))
+					fileObject.write(block)
+					for contentHash in hashes.values(): contentHash.update(block)
+					bytesRead += len(block)
+		except (OSError, http.client.HTTPException):
+			# keep the partial file for resuming
+			return None
+		finally:
+			response.close()
+
+		if not self.matches(bytesRead, {name: contentHash.hexdigest() for name, contentHash in hashes.items()}, expected):
+			os.remove(partialFilePath)
+			printOutput(getAlignedLine("[+++] "+os.path.basename(localFilePath)+" does NOT match its Packages entry", "ERROR"))
+			return None
+
+		os.replace(partialFilePath, localFilePath)
+		metadataCache.update(url, localFilePath, response, bytesRead, hashes['sha256'].hexdigest())
+		return humanReadableLinkSpeed((bytesRead-partialSize)/max(time.time()-startTime, 0.001))
+
+	def addToStore(self, localFilePath, storePath):
+		os.makedirs(os.path.dirname(storePath), exist_ok=True)
+		linkFile(localFilePath, storePath)
+
+	def matches(self, size, hexDigests, expected):
+		if 'Size' in expected and size != expected['Size']:
+			return False
+		for field, name in self.checksumFields.items():
+			if field in expected and hexDigests[name] != expected[field].lower():
+				return False
+		return True
+
+	def verify(self, localFilePath, expected, checkHashes):
+		'''
+		check an existing local deb against its Packages entry
+		'''
+		if not os.path.isfile(localFilePath):
+			return False
+		if not checkHashes or not any(field in expected for field in self.checksumFields):
+			return 'Size' in expected and os.path.getsize(localFilePath) == expected['Size']
+		hashes = {name: hashlib.new(name) for name in self.checksumFields.values()}
+		with open(localFilePath, "rb") as fileObject:
+			for block in iter(lambda: fileObject.read(downloadChunkSize), b''):
+				for contentHash in hashes.values(): contentHash.update(block)
+		return self.matches(os.path.getsize(localFilePath), {name: contentHash.hexdigest() for name, contentHash in hashes.items()}, expected)
+
+# Writes the built Packages file and its compressed versions at once, then their Release file
+class PackagesBuilder:
+	hashNames = {'MD5Sum': 'md5', 'SHA1': 'sha1', 'SHA256': 'sha256'}
+
+	def __init__(self, path, pdiffCount=0):
+		self.path = path
+		self.pdiffCount = pdiffCount
+		self.releaseExtraFiles = []
+		self.architectures = set()
+		self.buffer = bytearray()
+		self.variants = []
+		for fileExtension, compressor in [('', None), ('.gz', zlib.compressobj(9, zlib.DEFLATED, 31)), ('.bz2', bz2.BZ2Compressor(9)), ('.xz', lzma.LZMACompressor())]:
+			self.variants.append({'path': path + fileExtension, 'fileObject': open(path + fileExtension + '.part', 'wb'),
+								'compressor': compressor, 'size': 0, 'hashes': {name: hashlib.new(name) for name in self.hashNames.values()}})
+
+	def writeStanza(self, stanza, architecture=None):
+		'''
+		append a package and the empty line after it, the packages are gathered and compressed in big blocks
+		stanza can be a memoryview of the Packages file it is copied from
+		'''
+		if architecture:
+			self.architectures.add(architecture)
+		self.buffer += stanza
+		self.buffer += b'\n\n'
+		if len(self.buffer) >= buildBufferSize:
+			self.flush()
+
+	def flush(self):
+		if not self.buffer:
+			return
+		data = self.buffer
+		self.buffer = bytearray()
+		for variant in self.variants:
+			self.writeVariant(variant, data if variant['compressor'] == None else variant['compressor'].compress(data))
+
+	def writeVariant(self, variant, data):
+		if not data:
+			return
+		variant['fileObject'].write(data)
+		variant['size'] += len(data)
+		for contentHash in variant['hashes'].values(): contentHash.update(data)
+
+	def close(self, releaseInfo=None, byHash=False):
+		'''
+		finish the Packages files, rename them in place then write the Release file next to them
+		releaseInfo is the location of a file of Release fields, byHash links every Packages file to by-hash/<hash name>/<hash>
+		'''
+		self.flush()
+		for variant in self.variants:
+			if variant['compressor'] != None:
+				self.writeVariant(variant, variant['compressor'].flush())
+			variant['fileObject'].close()
+		if self.pdiffCount and os.path.isfile(self.path):
+			self.writePdiff()
+		for variant in self.variants:
+			os.replace(variant['path'] + '.part', variant['path'])
+		directory = os.path.dirname(self.path)
+		releasePath = os.path.join(directory, 'Release')
+		if byHash:
+			# like apt-ftparchive only the copies of this build and of the previous Release file are kept
+			keptHashes = {hashName: set() for hashName in self.hashNames}
+			if os.path.isfile(releasePath):
+				for entry in parseReleaseFile(releasePath).values():
+					for hashName in self.hashNames:
+						if hashName in entry: keptHashes[hashName].add(entry[hashName])
+			for variant in self.variants:
+				for hashName, name in self.hashNames.items():
+					keptHashes[hashName].add(variant['hashes'][name].hexdigest())
+					hashPath = os.path.join(directory, 'by-hash', hashName, variant['hashes'][name].hexdigest())
+					if os.path.isfile(hashPath):
+						continue
+					os.makedirs(os.path.dirname(hashPath), exist_ok=True)
+					try:
+						os.link(variant['path'], hashPath)
+					except OSError:
+						shutil.copyfile(variant['path'], hashPath)
+			for hashName in self.hashNames:
+				hashDirectory = os.path.join(directory, 'by-hash', hashName)
+				for fileName in os.listdir(hashDirectory):
+					if fileName not in keptHashes[hashName]:
+						os.remove(os.path.join(hashDirectory, fileName))
+		self.writeRelease(releasePath, releaseInfo, byHash)
+
+	def writePdiff(self):
+		'''
+		add the changes from the last built Packages file to the Packages.diff directory, keeping the last pdiffCount of them
+		'''
+		diffDirectory = self.path + ".diff"
+		indexPath = os.path.join(diffDirectory, "Index")
+		with open(self.path, 'rb') as fileObject:
+			oldData = fileObject.read()
+		with open(self.path + '.part', 'rb') as fileObject:
+			newData = fileObject.read()
+		pdiffIndex = None
+		if os.path.isfile(indexPath):
+			with open(indexPath, 'rb') as fileObject:
+				pdiffIndex = parsePdiffIndex(fileObject.read())
+		# the history goes on only from the Packages file it ended with
+		if pdiffIndex == None or pdiffIndex['current'].get('SHA256') != hashlib.sha256(oldData).hexdigest():
+			pdiffIndex = {'history': [], 'patches': {}, 'downloads': {}}
+		os.makedirs(diffDirectory, exist_ok=True)
+		if oldData != newData:
+			patchName = time.strftime("%Y-%m-%d-%H%M.%S", time.gmtime())
+			while patchName in pdiffIndex['patches']:
+				patchName += "-1"
+			patchData = makeEdPatch(oldData, newData)
+			compressedPatchData = gzip.compress(patchData, mtime=0)
+			with open(os.path.join(diffDirectory, patchName + ".gz"), 'wb') as fileObject:
+				fileObject.write(compressedPatchData)
+			pdiffIndex['history'].append({'size': len(oldData), 'SHA256': hashlib.sha256(oldData).hexdigest(), 'name': patchName})
+			pdiffIndex['patches'][patchName] = {'size': len(patchData), 'SHA256': hashlib.sha256(patchData).hexdigest(), 'name': patchName}
+			pdiffIndex['downloads'][patchName + ".gz"] = {'size': len(compressedPatchData), 'SHA256': hashlib.sha256(compressedPatchData).hexdigest(), 'name': patchName + ".gz"}
+		for entry in pdiffIndex['history'][:-self.pdiffCount]:
+			pdiffIndex['patches'].pop(entry['name'], None)
+			pdiffIndex['downloads'].pop(entry['name'] + ".gz", None)
+			if os.path.isfile(os.path.join(diffDirectory, entry['name'] + ".gz")):
+				os.remove(os.path.join(diffDirectory, entry['name'] + ".gz"))
+		history = pdiffIndex['history'][-self.pdiffCount:]
+		indexLines = ["SHA256-Current: {} {}".format(hashlib.sha256(newData).hexdigest(), len(newData))]
+		for fieldName, entries in [('SHA256-History', history), ('SHA256-Patches', [pdiffIndex['patches'][entry['name']] for entry in history]),
+								('SHA256-Download', [pdiffIndex['downloads'][entry['name'] + ".gz"] for entry in history])]:
+			indexLines.append(fieldName + ":")
+			indexLines.extend(" {} {:>8} {}".format(entry['SHA256'], entry['size'], entry['name']) for entry in entries)
+		indexData = ("\n".join(indexLines) + "\n").encode()
+		with open(indexPath + '.part', 'wb') as fileObject:
+			fileObject.write(indexData)
+		os.replace(indexPath + '.part', indexPath)
+		self.releaseExtraFiles.append((os.path.basename(self.path) + ".diff/Index", len(indexData),
+										{hashName: hashlib.new(name, indexData).hexdigest() for hashName, name in self.hashNames.items()}))
+
+	def writeRelease(self, path, releaseInfo, byHash):
+		releaseFields = collections.OrderedDict()
+		if releaseInfo:
+			with open(releaseInfo, encoding='utf-8', errors='replace') as fObj:
+				releaseFields.update((name.strip(), value.strip()) for name, value in stanzaFieldPattern.findall(fObj.read()) if name.strip() not in self.hashNames)
+		releaseFields.setdefault('Architectures', " ".join(sorted(self.architectures)))
+		releaseFields['Date'] = time.strftime("%a, %d %b %Y %H:%M:%S UTC", time.gmtime())
+		if byHash:
+			releaseFields['Acquire-By-Hash'] = 'yes'
+		releaseLines = ["{}: {}".format(name, value) for name, value in releaseFields.items()]
+		releaseFiles = [(os.path.basename(variant['path']), variant['size'], {hashName: variant['hashes'][name].hexdigest() for hashName, name in self.hashNames.items()})
+						for variant in self.variants] + self.releaseExtraFiles
+		for hashName in self.hashNames:
+			releaseLines.append(hashName + ":")
+			for filePath, fileSize, fileHashes in releaseFiles:
+				releaseLines.append(" {} {:>16} {}".format(fileHashes[hashName], fileSize, filePath))
+		with open(path + '.part', 'w') as fObj:
+			fObj.write("\n".join(releaseLines) + "\n")
+		os.replace(path + '.part', path)
+
+# Serves the built repository in daemon mode, the precompressed files to clients accepting them
+class RepoRequestHandler(http.server.SimpleHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def __init__(self, *handlerArguments, servedPaths, **handlerOptions):
+		'''
+		servedPaths are the local files and directories by the first part of their url path, nothing else is served
+		'''
+		self.servedPaths = servedPaths
+		super().__init__(*handlerArguments, **handlerOptions)
+
+	def translate_path(self, path):
+		parts = [part for part in urllib.parse.unquote(urllib.parse.urlsplit(path).path).split('/') if part]
+		if not parts or parts[0] not in self.servedPaths or any(part in ('.', '..') or os.sep in part for part in parts):
+			return ""
+		return os.path.join(self.servedPaths[parts[0]], *parts[1:])
+
+	def list_directory(self, path):
+		self.send_error(404, "File not found")
+		return None
+
+	def send_head(self):
+		path = self.translate_path(self.path)
+		compressedPath = path+".gz"
+		if 'gzip' not in self.headers.get('Accept-Encoding', '') or not os.path.isfile(path) or not os.path.isfile(compressedPath) \
+			or os.path.getmtime(compressedPath) < os.path.getmtime(path):
+			return super().send_head()
+		fileObject = open(compressedPath, 'rb')
+		fileStat = os.fstat(fileObject.fileno())
+		self.send_response(200)
+		self.send_header("Content-Type", self.guess_type(path))
+		self.send_header("Content-Encoding", "gzip")
+		self.send_header("Content-Length", str(fileStat.st_size))
+		self.send_header("Last-Modified", self.date_time_string(fileStat.st_mtime))
+		self.send_header("Vary", "Accept-Encoding")
+		self.end_headers()
+		return fileObject
+
+	def copyfile(self, source, outputfile):
+		# the kernel sends the file to the socket by sendfile where it can
+		outputfile.flush()
+		self.connection.sendfile(source)
+
+	def log_message(self, format, *formatArguments):
+		if args.verbose: printOutput("[+++] "+self.address_string()+" "+format % formatArguments)
+
+# Timings and sizes of the run by phase, source and host, saved as JSON and as a Prometheus textfile
+class Metrics:
+	hostFields = ['requests', 'reusedConnections', 'dnsSeconds', 'connectSeconds', 'firstByteSeconds', 'totalSeconds', 'bytes']
+	sourceFields = ['requests', 'bytes', 'cacheHits', 'cacheMisses', 'decompressSeconds', 'parseSeconds', 'refreshSeconds']
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.startTime = time.time()
+		self.phases = collections.OrderedDict()
+		self.currentPhase = None
+		self.phaseStartTime = None
+		self.hosts = {}
+		self.sources = {}
+
+	def addHost(self, host, **values):
+		self.add(self.hosts, self.hostFields, host, values)
+
+	def addSource(self, source, **values):
+		self.add(self.sources, self.sourceFields, source, values)
+
+	def add(self, table, fields, key, values):
+		with self.lock:
+			entry = table.setdefault(key, dict.fromkeys(fields, 0))
+			for name, value in values.items():
+				entry[name] += value
+
+	def setPhase(self, name):
+		'''
+		end the current phase adding its wall time, then start the named one, None for no phase
+		'''
+		with self.lock:
+			if self.currentPhase != None:
+				self.phases[self.currentPhase] = self.phases.get(self.currentPhase, 0)+time.time()-self.phaseStartTime
+			self.currentPhase = name
+			self.phaseStartTime = time.time()
+
+	def getReport(self):
+		self.setPhase(self.currentPhase)
+		with self.lock:
+			return {'startTime': self.startTime, 'wallSeconds': time.time()-self.startTime, 'phases': dict(self.phases),
+					'sources': {source: dict(entry) for source, entry in self.sources.items()}, 'hosts': {host: dict(entry) for host, entry in self.hosts.items()}}
+
+	def save(self, jsonPath=None, prometheusPath=None):
+		report = self.getReport()
+		if jsonPath:
+			saveJsonFile(jsonPath, report, indent="\t")
+		if prometheusPath:
+			# the textfile collector reads the file at any time, so it's replaced at once
+			lines = ["# TYPE repomanager_wall_seconds gauge", "repomanager_wall_seconds {:.6f}".format(report['wallSeconds']), "# TYPE repomanager_phase_seconds gauge"]
+			lines += ['repomanager_phase_seconds{{phase="{}"}} {:.6f}'.format(name, seconds) for name, seconds in report['phases'].items()]
+			for tableName, labelName, fields in [('sources', 'source', self.sourceFields), ('hosts', 'host', self.hostFields)]:
+				for field in fields:
+					metricName = "repomanager_{}_{}".format(labelName, re.sub(r'([A-Z])', r'_\1', field).lower())
+					lines.append("# TYPE {} gauge".format(metricName))
+					for key, entry in sorted(report[tableName].items()):
+						lines.append('{}{{{}="{}"}} {}'.format(metricName, labelName, key.replace('\\', '\\\\').replace('"', '\\"'), round(entry[field], 6)))
+			with open(prometheusPath+".part", "w") as fileObject:
+				fileObject.write("\n".join(lines)+"\n")
+			os.replace(prometheusPath+".part", prometheusPath)
 
 # Preparing some vars
 # in order - lz not yet implemented
 preferedPackagesExtensions=['Packages.gz', 'Packages.bz2', 'Packages', 'Packages.lzma', 'Packages.xz']
 #preferedPackagesExtensions=['Packages.gz', 'Packages.bz2', 'Packages', 'Packages.lz', 'Packages.lzma', 'Packages.xz']
 
+# Hashes of the Release files, the strongest first, by their hashlib names
+releaseHashNames = collections.OrderedDict([('SHA512', 'sha512'), ('SHA256', 'sha256'), ('SHA1', 'sha1'), ('MD5Sum', 'md5')])
+
+# How many functions the profile prints
+profiledFunctions=25
+
+# A source in daemon mode is refreshed every interval more or less this fraction of it
+refreshJitter=0.25
+# The daemon serves the downloaded debs and the scanned debs in these directories of the built repository
+servedDebsDirectory="debs"
+servedScannedDirectory="local"
+
+# Downloads are read in chunks of this size, and the progress bar redrawn at most every interval seconds
+downloadChunkSize=65536
+progressInterval=0.1
+
+# Packages files are parsed in chunks of this size, and split between the parse jobs in parts of at least this size
+parseChunkSize=1048576
+parsePartSize=4194304
+# Built Packages files are compressed in blocks of at least this size
+buildBufferSize=1048576
+
+# Canonical names of the Packages file fields by their lower case name
+packagesFieldNames = {name.lower(): name for name in ['Package', 'Name', 'Version', 'Architecture', 'Description', 'Homepage',
+					'Depiction', 'Maintainer', 'Author', 'Dev', 'Sponsor', 'Section', 'Filename', 'Size', 'Installed-Size', 'MD5Sum',
+					'SHA1', 'SHA256', 'SHA512', 'Pre-Depends', 'Depends', 'Conflicts', 'Priority', 'Icon', 'Tag', 'Replaces',
+					'Breaks', 'Provides', 'Essential', 'Website', 'Suggests', 'Recommends']}
+# Packages are separated by empty lines
+stanzaSeparator = re.compile(rb'\r?\n(?:[ \t]*\r?\n)+')
+blankLineWithSpaces = re.compile(rb'\n[ \t]+\r?\n')
+# A field is a name and a value, continued by the lines starting with a space or a tab
+stanzaFieldPattern = re.compile(r'^([^:\s][^:\n]*):[ \t]*([^\n]*(?:\n[ \t][^\n]*)*)', re.M)
+filenameFieldPattern = re.compile(rb'^Filename:[^\n]*', re.M | re.I)
+
+# An ed command of a pdiff, a line or a range of lines then append, change or delete
+edCommandPattern = re.compile(rb'^(\d+)(?:,(\d+))?([acd])$')
+
+# An alternative of a relation, a name with an optional version constraint and architectures
+relationPattern = re.compile(r'\s*([^\s(\[<]+)\s*(?:\(\s*(<<|<=|>=|>>|=|<|>)\s*([^\s)]+)\s*\))?')
+
 # Variable for window width
 leftChars=shutil.get_terminal_size().columns-15
 rightChars=15
@@ -90,6 +1442,15 @@ randonHex40 = binascii.b2a_hex(os.urandom(20)) # 40 hex digits = 20 bytes
 deviceIdentifier = random.choice(iDeviceIdentifiers)
 iOSVersion = random.choice(iOSVersions)
 
+metrics = Metrics()
+connectionPool = ConnectionPool(max(4, args.host_jobs))
+packagesParser = PackagesParser(args.parse_jobs)
+metadataCache = MetadataCache(os.path.join(args.directory, "cacheIndex.json"))
+hostHealth = HostHealth(os.path.join(args.directory, "hostHealth.json"))
+# the Packages file of the scanned debs, its repository name is local
+scannedPackagesFile = os.path.join(args.directory, "local_Packages")
+formatSelector = FormatSelector(os.path.join(args.directory, "formatSpeeds.json"))
+
 # *********************** Defining useful functions
 
 # Human readable link speed given bytes
@@ -106,44 +1467,21 @@ def humanReadableLinkSpeed(num, suffix='B/s'):
 
 # download any file
 # Progress bar idea from http://stackoverflow.com/a/32300565/5650671
-def downloadFile(url, fileExtension='', packagesFileNumberInFileName=-1, response=None):
+def downloadFile(url, fileExtension='', packagesFileNumberInFileName=-1, response=None, expected=None):
 	'''
-	download a file and uncompress it if it's compressed
+	download a file and uncompress it if it's compressed, expected is its Release file entry to verify it
 	Return uncompressed local file name on success or None for whatever reason
 	'''
-	global sourceDomainName
-	global sourceCountPadded
-	if 'sourceCountPadded' not in globals(): sourceCountPadded="+++"
+	sourceCountPadded = sourceContext.countPadded
 	sourceDomainName = url.split("/")[2]
 
 	if url.endswith("Release"):
 		localFileName=sourceDomainName+"_Release"
 	elif url.endswith('.deb'):
-		if "=" in url:
-			localFileName = url.split('=')[-1]
-		else:
-			localFileName = url.split('/')[-1]
+		localFileName = getDebFileName(url)
 		localFilePath = os.path.join(args.download, localFileName)
 	else:
-		if url.endswith(".gz"):
-			fileExtension=".gz"
-		elif url.endswith(".bz2"):
-			fileExtension=".bz2"
-		elif url.endswith(".lz"):
-			fileExtension=".lz"
-		elif url.endswith(".lzma"):
-			fileExtension=".lzma"
-		elif url.endswith(".xz"):
-			fileExtension=".xz"
-		else:
-			fileExtension=""
-
-		if packagesFileNumberInFileName == -1:
-			packagesFileNumberInFileName=""
-		else:
-			packagesFileNumberInFileName="_"+packagesFileNumberInFileName
-
-		localFileName=sourceDomainName+"_Packages"+packagesFileNumberInFileName+fileExtension
+		localFileName, fileExtension = getPackagesFileName(url, packagesFileNumberInFileName)
 	
 	if response == None:
 		response = getResponse(url)
@@ -156,51 +1494,187 @@ def downloadFile(url, fileExtension='', packagesFileNumberInFileName=-1, respons
 	else:
 		uncompressedlocalFilePath = localFilePath[:localFilePath.rfind(fileExtension)]
 
+	# not modified since the last download
+	if response.status == 304:
+		response.close()
+		metrics.addSource(sourceDomainName, requests=1, cacheHits=1)
+		if args.verbose: printOutput(getAlignedLine("["+sourceCountPadded+"] "+localFileName+" not modified", "FOUND", GRN))
+		if fileExtension != '' and not os.path.isfile(uncompressedlocalFilePath):
+			if not uncompressFile(localFilePath, fileExtension):
+				printOutput(getAlignedLine("["+sourceCountPadded+"] "+localFileName+" can NOT be uncompressed", "FAILED"))
+		return str(uncompressedlocalFilePath)
+
 	remoteFileSize=getURLFileSize(response)
-	if os.path.isfile(localFilePath):
-		localFileSize=os.path.getsize(localFilePath)
-		if localFileSize == remoteFileSize:
-			if args.verbose: print(getAlignedLine("["+sourceCountPadded+"] "+localFileName+" already exists", "FOUND", GRN))
+	# servers without validators can be checked by the size only, if they tell it
+	if 'ETag' not in response.headers and 'Last-Modified' not in response.headers and 'Content-Length' in response.headers:
+		if os.path.isfile(localFilePath) and os.path.getsize(localFilePath) == remoteFileSize:
+			response.close()
+			metrics.addSource(sourceDomainName, requests=1, cacheHits=1)
+			if args.verbose: printOutput(getAlignedLine("["+sourceCountPadded+"] "+localFileName+" already exists", "FOUND", GRN))
 			return str(uncompressedlocalFilePath)
 
-	if args.verbose:
-		dataBlocks = []
-		bytesReadSoFar=0
-		windowsColumns=shutil.get_terminal_size().columns-26-len(sourceDomainName)
-		startTime=time.time()
-		while True:
-			block = response.read(1024)
-			dataBlocks.append(block)
-			bytesReadSoFar += len(block)
-			linkSpeed=bytesReadSoFar/(time.time()-startTime)
-			hash = ((windowsColumns*bytesReadSoFar)//remoteFileSize)
-			if not len(block):
-				print("[{}] {} [{}{}] {}% {} ".format(sourceCountPadded, sourceDomainName, '#' * windowsColumns, ' ' * 0, 100, humanReadableLinkSpeed(linkSpeed)))
-				break
-			print("[{}] {} [{}{}] {}% {} ".format(sourceCountPadded, sourceDomainName, '#' * hash, ' ' * (windowsColumns-hash), int(bytesReadSoFar/remoteFileSize*100), humanReadableLinkSpeed(linkSpeed)), end="\r")
-		data = b''.join(dataBlocks)
-	else:
-		data = response.read()
-	# Saving response to file
-	fileObject = open(localFilePath, "wb")
-	fileObject.write(data)
-	fileObject.close()
+	# Streaming the response to a temporary file in big chunks, uncompressing on the fly if possible
+	# then renaming them over the old ones, so memory stays the same for any file size
+	decompressor = StreamDecompressor(fileExtension) if fileExtension in StreamDecompressor.formats else None
+	temporaryFilePath = localFilePath+".part"
+	temporaryUncompressedFilePath = uncompressedlocalFilePath+".part"
+	contentHash = hashlib.sha256()
+	contentHashes = {'sha256': contentHash}
+	expectedHashName = getReleaseHashName(expected) if expected != None else None
+	if expectedHashName != None and releaseHashNames[expectedHashName] not in contentHashes:
+		contentHashes[releaseHashNames[expectedHashName]] = hashlib.new(releaseHashNames[expectedHashName])
+	bytesReadSoFar = 0
+	decompressSeconds = 0
+	windowsColumns=shutil.get_terminal_size().columns-26-len(sourceDomainName)
+	startTime=time.time()
+	lastProgressTime=0
+	uncompressedObject = None
+	try:
+		with open(temporaryFilePath, "wb") as fileObject:
+			if decompressor != None: uncompressedObject = open(temporaryUncompressedFilePath, "wb")
+			while True:
+				block = response.read(downloadChunkSize)
+				if not block:
+					break
+				fileObject.write(block)
+				for blockHash in contentHashes.values(): blockHash.update(block)
+				bytesReadSoFar += len(block)
+				if decompressor != None:
+					try:
+						decompressStartTime = time.time()
+						uncompressedObject.write(decompressor.decompress(block))
+						decompressSeconds += time.time()-decompressStartTime
+					except (OSError, EOFError, zlib.error, lzma.LZMAError):
+						# keep downloading, it will be reported as not uncompressed
+						decompressor = None
+						uncompressedObject.close()
+						uncompressedObject = None
+						os.remove(temporaryUncompressedFilePath)
+				# redraw the progress bar only every progressInterval seconds
+				if args.verbose and time.time()-lastProgressTime >= progressInterval:
+					lastProgressTime = time.time()
+					printProgress(sourceCountPadded, sourceDomainName, windowsColumns, bytesReadSoFar, remoteFileSize, startTime, end="\r")
+			if decompressor != None:
+				try:
+					uncompressedObject.write(decompressor.flush())
+				except (OSError, EOFError, zlib.error, lzma.LZMAError):
+					decompressor = None
+			if uncompressedObject != None: uncompressedObject.close()
+	except (OSError, http.client.HTTPException) as e:
+		response.close()
+		for partialFilePath in [temporaryFilePath, temporaryUncompressedFilePath]:
+			if os.path.isfile(partialFilePath): os.remove(partialFilePath)
+		printOutput(getAlignedLine("["+sourceCountPadded+"] "+localFileName+" download interrupted "+str(e), "FAILED"))
+		return None
 	response.close()
+	metrics.addSource(sourceDomainName, requests=1, cacheMisses=1, bytes=bytesReadSoFar, decompressSeconds=decompressSeconds)
+	formatSelector.addTransfer(sourceDomainName, bytesReadSoFar, time.time()-startTime-decompressSeconds)
+	if decompressor != None: formatSelector.addDecompression(fileExtension, bytesReadSoFar, decompressSeconds)
+	if args.verbose: printProgress(sourceCountPadded, sourceDomainName, windowsColumns, bytesReadSoFar, bytesReadSoFar, startTime)
+
+	# a download not matching its Release file entry is not used
+	if expected != None and (bytesReadSoFar != expected['size'] or (expectedHashName != None and contentHashes[releaseHashNames[expectedHashName]].hexdigest() != expected[expectedHashName])):
+		for partialFilePath in [temporaryFilePath, temporaryUncompressedFilePath]:
+			if os.path.isfile(partialFilePath): os.remove(partialFilePath)
+		printOutput(getAlignedLine("["+sourceCountPadded+"] "+localFileName+" does NOT match the Release file", "FAILED"))
+		return None
+
+	os.replace(temporaryFilePath, localFilePath)
+	metadataCache.update(url, localFilePath, response, bytesReadSoFar, contentHash.hexdigest())
 
-	# uncompressing if compressed and the uncompressed doesn't exists
+	# uncompressing if compressed, it's a new version
 	if fileExtension != '':
-		compress=True
-		if os.path.isfile(uncompressedlocalFilePath) and os.path.isfile(localFilePath):
-			# if the last modification time difference between the two files is big enough (5m) do uncompress
-			if (os.path.getmtime(localFilePath)-os.path.getmtime(uncompressedlocalFilePath)) < 300:
-				compress = False
-		
-		if compress:
+		if decompressor != None:
+			os.replace(temporaryUncompressedFilePath, uncompressedlocalFilePath)
+			result = True
+		else:
+			if os.path.isfile(temporaryUncompressedFilePath): os.remove(temporaryUncompressedFilePath)
 			result = uncompressFile(localFilePath, fileExtension)
-			if result and args.verbose: print(getAlignedLine("["+sourceCountPadded+"] "+localFileName+" successfully uncompressed", "SUCCESS", GRN))
-			if not result: print(getAlignedLine("["+sourceCountPadded+"] "+localFileName+" can NOT be uncompressed", "FAILED"))
+		if result and args.verbose: printOutput(getAlignedLine("["+sourceCountPadded+"] "+localFileName+" successfully uncompressed", "SUCCESS", GRN))
+		if not result: printOutput(getAlignedLine("["+sourceCountPadded+"] "+localFileName+" can NOT be uncompressed", "FAILED"))
 	return str(uncompressedlocalFilePath)
 
+# Print the progress bar of a download
+def printProgress(sourceCountPadded, sourceDomainName, windowsColumns, bytesReadSoFar, remoteFileSize, startTime, end="\n"):
+	linkSpeed=bytesReadSoFar/max(time.time()-startTime, 0.001)
+	if remoteFileSize:
+		percent=min(100, int(bytesReadSoFar/remoteFileSize*100))
+	else:
+		percent=100
+	hash = (windowsColumns*percent)//100
+	printOutput("[{}] {} [{}{}] {}% {} ".format(sourceCountPadded, sourceDomainName, '#' * hash, ' ' * (windowsColumns-hash), percent, humanReadableLinkSpeed(linkSpeed)), end=end)
+
+# SHA256 of a local file
+def getFileHash(path, hashName='sha256'):
+	contentHash = hashlib.new(hashName)
+	with open(path, 'rb') as fileObject:
+		for block in iter(lambda: fileObject.read(downloadChunkSize), b''):
+			contentHash.update(block)
+	return contentHash.hexdigest()
+
+# Local file name of a Packages file url and its compression extension
+def getPackagesFileName(url, packagesFileNumberInFileName=-1):
+	fileExtension = ""
+	for compressionExtension in [".gz", ".bz2", ".lz", ".lzma", ".xz"]:
+		if url.endswith(compressionExtension):
+			fileExtension = compressionExtension
+
+	if packagesFileNumberInFileName == -1:
+		packagesFileNumberInFileName=""
+	else:
+		packagesFileNumberInFileName="_"+packagesFileNumberInFileName
+
+	return url.split("/")[2]+"_Packages"+packagesFileNumberInFileName+fileExtension, fileExtension
+
+# Location of a deb in the store by its SHA256
+def getStorePath(storeDirectory, sha256):
+	sha256 = sha256.lower()
+	return os.path.join(storeDirectory, sha256[:2], sha256)
+
+# Hard link a file to another location, or copy it if they are on different file systems
+def linkFile(sourcePath, destinationPath):
+	if os.path.isfile(destinationPath) and os.path.samefile(sourcePath, destinationPath):
+		return
+	temporaryPath = destinationPath+".link"
+	if os.path.lexists(temporaryPath): os.remove(temporaryPath)
+	try:
+		os.link(sourcePath, temporaryPath)
+	except OSError:
+		shutil.copyfile(sourcePath, temporaryPath)
+	os.replace(temporaryPath, destinationPath)
+
+# Remove the debs of the store which no Packages file has anymore
+def collectStoreGarbage(storeDirectory, packagesFiles):
+	if not packagesFiles:
+		printOutput(getAlignedLine("[+++] No Packages files, the store is kept as it is", "NOTICE", YEL))
+		return
+	if packagesIndex != None:
+		allPackages = packagesIndex.getAllPackages(packagesFiles, ['SHA256'])
+	else:
+		allPackages = packagesParser.getAllPackages(packagesFiles)
+	referencedHashes = {packageInfo['SHA256'].lower() for packagesFile, offset, packageInfo in allPackages if packageInfo.get('SHA256')}
+	# the Packages files kept from before, of the sources which failed to refresh this time, still reference their debs
+	otherPackagesFiles = [packagesFile for packagesFile in listLocalPackagesFiles() if packagesFile not in packagesFiles]
+	referencedHashes.update(packageInfo['SHA256'].lower() for packagesFile, offset, packageInfo in packagesParser.getAllPackages(otherPackagesFiles) if packageInfo.get('SHA256'))
+	removedDebs = 0
+	freedBytes = 0
+	for directoryPath, directoryNames, fileNames in os.walk(storeDirectory):
+		for fileName in fileNames:
+			filePath = os.path.join(directoryPath, fileName)
+			# unfinished links are garbage too
+			if fileName in referencedHashes and filePath == getStorePath(storeDirectory, fileName):
+				continue
+			freedBytes += os.path.getsize(filePath)
+			os.remove(filePath)
+			removedDebs += 1
+	printOutput("[+++] Store: {}{}{} debs removed, {}{:.1f}{} MB freed.".format(GRN, removedDebs, NOC, GRN, freedBytes/1048576, NOC))
+
+# Local file name of a deb url
+def getDebFileName(url):
+	if "=" in url:
+		return url.split('=')[-1]
+	return url.split('/')[-1]
+
 # Called by DownloadFile function
 # uncompress a local file
 def uncompressFile(path, compressionFormat):
@@ -215,71 +1689,418 @@ def uncompressFile(path, compressionFormat):
 		compressedObject = bz2.open(path, 'rb')
 		#elif compressionFormat == ".lz":
 		#compressedObject = gzip.open(path, 'rb') ******************** NOT implemented yet
-	elif compressionFormat == ".lzma" or compressionFormat == ".xz":
-		compressedObject = lzma.open(path, 'rb')
+	elif compressionFormat == ".xz":
+		compressedObject = lzma.open(path, 'rb', format=lzma.FORMAT_XZ)
+	elif compressionFormat == ".lzma":
+		compressedObject = lzma.open(path, 'rb', format=lzma.FORMAT_ALONE)
 	else:
 		return False
 
-	with open(uncompressedFileName, 'wb') as uncompressedObject:
+	startTime = time.time()
+	with compressedObject, open(uncompressedFileName, 'wb') as uncompressedObject:
 		try:
-			shutil.copyfileobj(compressedObject, uncompressedObject)
+			shutil.copyfileobj(compressedObject, uncompressedObject, downloadChunkSize)
+			formatSelector.addDecompression(compressionFormat, os.path.getsize(path), time.time()-startTime)
 			return True
-		except OSError as e:
-			print(getAlignedLine("["+sourceCountPadded+"] "+e.strerror, "FAILED"))
-		else:
-			uncompressedObject.close()
-			compressedObject.close()
+		except (OSError, EOFError, lzma.LZMAError) as e:
+			printOutput(getAlignedLine("["+sourceContext.countPadded+"] "+os.path.basename(path)+" "+str(e), "FAILED"))
+		finally:
+			metrics.addSource(os.path.basename(path).split('_')[0], decompressSeconds=time.time()-startTime)
 
 	return False
 
+# Read the files listed in a Release file
+def parseReleaseFile(path):
+	'''
+	Returns a dictonary of the files paths, in the Release file order, to a dictonary of their size and hashes
+	'''
+	releaseFiles = {}
+	hashName = None
+	with open(path, encoding='utf-8', errors='replace') as fileObject:
+		for lineInRelease in fileObject:
+			if not lineInRelease[:1].isspace():
+				hashName = lineInRelease.split(':')[0].strip()
+				hashName = hashName if hashName in releaseHashNames else None
+				continue
+			lineSeparatedBySpace = lineInRelease.split()
+			if hashName == None or len(lineSeparatedBySpace) != 3 or not lineSeparatedBySpace[1].isdigit():
+				continue
+			fileHash, fileSize, filePath = lineSeparatedBySpace
+			entry = releaseFiles.setdefault(filePath, {'size': int(fileSize)})
+			entry[hashName] = fileHash.lower()
+	return releaseFiles
+
+# The strongest hash of a Release file entry
+def getReleaseHashName(entry):
+	for hashName in releaseHashNames:
+		if hashName in entry:
+			return hashName
+	return None
+
+# Check a local file against its Release file entry
+def matchesReleaseEntry(path, entry):
+	hashName = getReleaseHashName(entry)
+	if hashName == None or not os.path.isfile(path) or os.path.getsize(path) != entry['size']:
+		return False
+	return getFileHash(path, releaseHashNames[hashName]) == entry[hashName]
+
+# Download a Packages file listed in the Release file, unless the local one has the same hash
+def downloadPackagesFile(url, remoteFilePath, releaseFiles, packagesFileNumberInFileName=-1):
+	'''
+	Return uncompressed local file name on success or None for whatever reason
+	'''
+	localFileName, fileExtension = getPackagesFileName(url, packagesFileNumberInFileName)
+	localFilePath = os.path.join(args.directory, localFileName)
+	uncompressedLocalFilePath = localFilePath[:len(localFilePath)-len(fileExtension)]
+	uncompressedEntry = releaseFiles.get(remoteFilePath[:len(remoteFilePath)-len(fileExtension)])
+	if uncompressedEntry != None and matchesReleaseEntry(uncompressedLocalFilePath, uncompressedEntry):
+		unchanged = True
+	else:
+		# the uncompressed one is made again if it does NOT match
+		unchanged = fileExtension != "" and matchesReleaseEntry(localFilePath, releaseFiles[remoteFilePath]) and \
+					((uncompressedEntry == None and os.path.isfile(uncompressedLocalFilePath)) or uncompressFile(localFilePath, fileExtension))
+	if unchanged:
+		metrics.addSource(url.split('/')[2], cacheHits=1)
+		if args.verbose: printOutput(getAlignedLine("["+sourceContext.countPadded+"] "+localFileName+" unchanged in Release", "FOUND", GRN))
+		return uncompressedLocalFilePath
+	# patch the local one if the repository has pdiffs, the compressed local one is out of date then
+	pdiffIndexEntry = releaseFiles.get(remoteFilePath[:len(remoteFilePath)-len(fileExtension)]+".diff/Index")
+	if pdiffIndexEntry != None and os.path.isfile(uncompressedLocalFilePath) and \
+		updateByPdiff(url[:len(url)-len(fileExtension)]+".diff/", pdiffIndexEntry, uncompressedLocalFilePath, uncompressedEntry):
+		if fileExtension != "" and os.path.isfile(localFilePath): os.remove(localFilePath)
+		return uncompressedLocalFilePath
+	return downloadFile(url, packagesFileNumberInFileName=packagesFileNumberInFileName, expected=releaseFiles[remoteFilePath])
+
+# Download a small file in memory, like a pdiff, checking it against its Release file entry if known
+def downloadData(url, expected=None):
+	'''
+	Returns the file content or None
+	'''
+	response = getResponse(url)
+	if response == None:
+		return None
+	try:
+		data = response.read()
+	except (OSError, http.client.HTTPException):
+		data = None
+	response.close()
+	metrics.addSource(url.split('/')[2], requests=1, bytes=len(data or b''))
+	if data == None or response.status != 200 or (expected != None and not matchesReleaseData(data, expected)):
+		return None
+	return data
+
+# Check a file content against its Release file entry
+def matchesReleaseData(data, entry):
+	hashName = getReleaseHashName(entry)
+	return hashName != None and len(data) == entry['size'] and hashlib.new(releaseHashNames[hashName], data).hexdigest() == entry[hashName]
+
+# Read a Packages.diff/Index file
+def parsePdiffIndex(data):
+	'''
+	Returns a dictonary of the current Packages file, its history and its patches as Release file entries, or None
+	'''
+	fields = {name: value for name, value in stanzaFieldPattern.findall(data.decode('utf-8', 'replace').replace('\r', ''))}
+	for hashName in releaseHashNames:
+		if hashName+'-Current' in fields:
+			break
+	else:
+		return None
+	pdiffIndex = {'merged': fields.get('X-Patch-Precedence', '').strip() == 'merged', 'history': [], 'patches': {}, 'downloads': {}}
+	currentHash, currentSize = fields[hashName+'-Current'].split()[:2]
+	pdiffIndex['current'] = {'size': int(currentSize), hashName: currentHash.lower()}
+	for fieldName, key in [('-History', 'history'), ('-Patches', 'patches'), ('-Download', 'downloads')]:
+		for lineInIndex in fields.get(hashName+fieldName, '').splitlines():
+			lineSeparatedBySpace = lineInIndex.split()
+			if len(lineSeparatedBySpace) != 3 or not lineSeparatedBySpace[1].isdigit():
+				continue
+			entry = {'size': int(lineSeparatedBySpace[1]), hashName: lineSeparatedBySpace[0].lower(), 'name': lineSeparatedBySpace[2]}
+			if key == 'history':
+				pdiffIndex['history'].append(entry)
+			else:
+				pdiffIndex[key][entry['name']] = entry
+	return pdiffIndex
+
+# Apply an ed script, as made by diff --ed, to the lines of a file
+def applyEdPatch(lines, patch):
+	'''
+	lines are kept with their line endings, the commands are expected from the end of the file to its start
+	Returns the patched lines, raises ValueError for a broken patch
+	'''
+	patchLines = patch.splitlines(keepends=True)
+	index = 0
+	currentLine = 0
+	while index < len(patchLines):
+		command = patchLines[index].rstrip(b'\r\n')
+		index += 1
+		if not command:
+			continue
+		# a line of a single dot was written as two dots then fixed by this command
+		if command == b's/.//':
+			if currentLine < 1 or currentLine > len(lines):
+				raise ValueError("s/.// out of the file")
+			lines[currentLine-1] = lines[currentLine-1][1:]
+			continue
+		match = edCommandPattern.match(command)
+		if match == None:
+			raise ValueError("unknown ed command "+command.decode('utf-8', 'replace'))
+		firstLine = int(match.group(1))
+		lastLine = int(match.group(2)) if match.group(2) else firstLine
+		if lastLine > len(lines) or firstLine > lastLine or (firstLine < 1 and match.group(3) != b'a'):
+			raise ValueError("ed command out of the file")
+		newLines = []
+		if match.group(3) in b'ac':
+			while index < len(patchLines) and patchLines[index].rstrip(b'\r\n') != b'.':
+				newLines.append(patchLines[index])
+				index += 1
+			if index == len(patchLines):
+				raise ValueError("ed text without its end")
+			index += 1
+		if match.group(3) == b'a':
+			lines[firstLine:firstLine] = newLines
+			currentLine = firstLine + len(newLines)
+		else:
+			lines[firstLine-1:lastLine] = newLines
+			currentLine = firstLine - 1 + len(newLines)
+	return lines
+
+# Make an ed script changing a Packages file to another, comparing them package by package
+def makeEdPatch(oldData, newData):
+	oldStanzas = splitIntoStanzasLines(oldData)
+	newStanzas = splitIntoStanzasLines(newData)
+	# first line number of every old package
+	oldLineNumbers = [1]
+	for stanzaLines in oldStanzas:
+		oldLineNumbers.append(oldLineNumbers[-1] + len(stanzaLines))
+	commands = []
+	opcodes = difflib.SequenceMatcher(None, [b''.join(stanzaLines) for stanzaLines in oldStanzas], [b''.join(stanzaLines) for stanzaLines in newStanzas], autojunk=False).get_opcodes()
+	# from the end to the start, so the line numbers of the next commands stay the same
+	for tag, oldStart, oldEnd, newStart, newEnd in reversed(opcodes):
+		if tag == 'equal':
+			continue
+		newLines = [line for stanzaLines in newStanzas[newStart:newEnd] for line in stanzaLines]
+		firstLine, lastLine = oldLineNumbers[oldStart], oldLineNumbers[oldEnd] - 1
+		if tag == 'insert':
+			commands.append("{}a\n".format(firstLine - 1).encode())
+		elif tag == 'delete':
+			commands.append("{},{}d\n".format(firstLine, lastLine).encode())
+			continue
+		else:
+			commands.append("{},{}c\n".format(firstLine, lastLine).encode())
+		commands.extend(line if line.endswith(b'\n') else line + b'\n' for line in newLines)
+		commands.append(b'.\n')
+	return b''.join(commands)
+
+# Lines of every package of a Packages file, with the empty lines after it
+def splitIntoStanzasLines(data):
+	stanzas = []
+	stanzaLines = []
+	for line in data.splitlines(keepends=True):
+		stanzaLines.append(line)
+		if not line.strip():
+			stanzas.append(stanzaLines)
+			stanzaLines = []
+	if stanzaLines:
+		stanzas.append(stanzaLines)
+	return stanzas
+
+# Bring a local Packages file up to date with the pdiffs of its repository
+def updateByPdiff(diffURL, indexEntry, localFilePath, expected=None):
+	'''
+	diffURL is the url of the Packages.diff directory, expected the Release file entry of the uncompressed Packages file
+	Returns True if the local file was patched, False if it must be downloaded fully
+	'''
+	indexData = downloadData(diffURL+"Index", indexEntry)
+	pdiffIndex = parsePdiffIndex(indexData) if indexData != None else None
+	if pdiffIndex == None:
+		return False
+	with open(localFilePath, 'rb') as fileObject:
+		data = fileObject.read()
+	hashName = getReleaseHashName(pdiffIndex['current'])
+	localHash = hashlib.new(releaseHashNames[hashName], data).hexdigest()
+	if localHash == pdiffIndex['current'][hashName]:
+		return True
+	historyHashes = [entry[hashName] for entry in pdiffIndex['history']]
+	if localHash not in historyHashes:
+		if args.verbose: printOutput(getAlignedLine("["+sourceContext.countPadded+"] "+localFilePath.split('/')[-1]+" is older than its pdiffs", "NOTICE", YEL))
+		return False
+	# merged patches change any old version to the current one at once
+	patchNames = [entry['name'] for entry in pdiffIndex['history'][historyHashes.index(localHash):]]
+	if pdiffIndex['merged']:
+		patchNames = patchNames[:1]
+	lines = data.splitlines(keepends=True)
+	try:
+		for patchName in patchNames:
+			patchData = downloadData(diffURL+patchName+".gz", pdiffIndex['downloads'].get(patchName+".gz"))
+			if patchData == None:
+				raise ValueError(patchName+" can NOT be downloaded")
+			patchData = gzip.decompress(patchData)
+			if patchName in pdiffIndex['patches'] and not matchesReleaseData(patchData, pdiffIndex['patches'][patchName]):
+				raise ValueError(patchName+" does NOT match the Index")
+			lines = applyEdPatch(lines, patchData)
+	except (ValueError, OSError, EOFError) as e:
+		if args.verbose: printOutput(getAlignedLine("["+sourceContext.countPadded+"] pdiff "+str(e), "NOTICE", YEL))
+		return False
+	data = b''.join(lines)
+	if not matchesReleaseData(data, pdiffIndex['current']) or (expected != None and not matchesReleaseData(data, expected)):
+		if args.verbose: printOutput(getAlignedLine("["+sourceContext.countPadded+"] "+localFilePath.split('/')[-1]+" patched does NOT match", "NOTICE", YEL))
+		return False
+	with open(localFilePath+".part", 'wb') as fileObject:
+		fileObject.write(data)
+	os.replace(localFilePath+".part", localFilePath)
+	if args.verbose: printOutput(getAlignedLine("["+sourceContext.countPadded+"] "+localFilePath.split('/')[-1]+" patched with "+str(len(patchNames))+" pdiffs", "SUCCESS", GRN))
+	return True
+
+# Whether a request failed because of the host, refused, reset, timed out or not resolved
+# and not because of the request itself, like a url with a space
+def isHostFailure(error):
+	return isinstance(error, OSError)
+
+# Whether a request which failed may succeed if made again, the host didn't answer or was busy
+# and not a missing or forbidden file nor a bad url
+def isTransientError(error):
+	if isinstance(error, HTTPError):
+		return error.code >= 500 or error.code in (408, 429)
+	if isinstance(error, URLError):
+		return isHostFailure(error.reason)
+	return isHostFailure(error)
+
 # Make a HTTP request with specific headers
-def getResponse(url):
+def getResponse(url, extraHeaders=None, method="GET"):
 	'''
-	Returns HTTPResponse or None if it can't get the file
+	extraHeaders like Range replace the conditional headers
+	Returns HTTPResponse, with status 304 if the cached local copy is not modified, or None if it can't get the file
+	the request isn't made if the host keeps failing
 	'''
-	request = Request(url)
-	request.add_header('User-Agent', 'Telesphoreo APT-HTTP/1.0.592')
-	request.add_header('X-Machine', deviceIdentifier)
-	request.add_header('X-Firmware', iOSVersion)
-	request.add_header('X-Unique-ID', randonHex40)
+	headers = {
+		'User-Agent': 'Telesphoreo APT-HTTP/1.0.592',
+		'X-Machine': deviceIdentifier,
+		'X-Firmware': iOSVersion,
+		'X-Unique-ID': randonHex40,
+	}
+	sourceCountPadded = sourceContext.countPadded
 	domainName = url.split('/')[2]
 	fileName = url.split('/')[-1]
 	response=None
 
+	if extraHeaders:
+		headers.update(extraHeaders)
+	else:
+		headers.update(metadataCache.getConditionalHeaders(url))
+
+	if hostHealth.isSkipped(domainName):
+		if args.verbose: printOutput(getAlignedLine("["+sourceCountPadded+"] "+domainName+" "+fileName+" skipped, the host keeps failing", "NOTICE", YEL))
+		sourceContext.lastError = URLError(domainName+" is skipped, it keeps failing")
+		return None
+
+	startTime = time.time()
 	try:
-		response = urlopen(request, timeout=3)
+		# keep-alive connections can't go through a proxy, let urllib handle it
+		if url.split(':')[0] in getproxies():
+			response = urlopen(Request(url, headers=headers, method=method), timeout=hostHealth.getTimeout(domainName))
+		else:
+			response = connectionPool.request(url, headers, timeout=hostHealth.getTimeout(domainName), method=method)
 	except HTTPError as e:
+		hostHealth.addResponse(domainName, time.time()-startTime)
+		# urllib raises not modified as an error
+		if e.code == 304:
+			return e
+		sourceContext.lastError = e
+		# some servers don't know HEAD
+		if method == "HEAD" and e.code in (405, 501):
+			return getResponse(url, extraHeaders)
 		if e.code == 404:
-			if args.verbose: print(getAlignedLine("["+sourceCountPadded+"] "+domainName+" "+fileName+" file is NOT online", "NOTICE", YEL))
+			if args.verbose: printOutput(getAlignedLine("["+sourceCountPadded+"] "+domainName+" "+fileName+" file is NOT online", "NOTICE", YEL))
 		else:
-			if args.verbose: print(getAlignedLine("["+sourceCountPadded+"] "+domainName+" "+fileName+" HTTPError "+ str(e.code), "ERROR"))
+			if args.verbose: printOutput(getAlignedLine("["+sourceCountPadded+"] "+domainName+" "+fileName+" HTTPError "+ str(e.code), "ERROR"))
 	except URLError as e:
-		print(getAlignedLine("["+sourceCountPadded+"] "+domainName+" "+fileName+" URLError "+ str(e.reason), "ERROR"))
+		sourceContext.lastError = e
+		printOutput(getAlignedLine("["+sourceCountPadded+"] "+domainName+" "+fileName+" URLError "+ str(e.reason), "ERROR"))
+		if isHostFailure(e.reason) and hostHealth.addFailure(domainName):
+			printOutput(getAlignedLine("["+sourceCountPadded+"] "+domainName+" keeps failing, skipped for now", "ERROR"))
 	except:
-		print(getAlignedLine("["+sourceCountPadded+"] "+domainName+" "+fileName, "ERROR"))
+		sourceContext.lastError = sys.exc_info()[1]
+		printOutput(getAlignedLine("["+sourceCountPadded+"] "+domainName+" "+fileName, "ERROR"))
+		if isHostFailure(sys.exc_info()[1]) and hostHealth.addFailure(domainName):
+			printOutput(getAlignedLine("["+sourceCountPadded+"] "+domainName+" keeps failing, skipped for now", "ERROR"))
 	else:
+		hostHealth.addResponse(domainName, time.time()-startTime)
 		return response
 	if response != None: response.close()
 	return None
 
+# Choose the compression of every Packages file of a Release file, by their sizes in it
+def selectPackagesFiles(sourceURL, releaseFiles):
+	'''
+	Returns a list of the paths of the Packages files to download, in the Release file order
+	'''
+	domainName = sourceURL.split('/')[2]
+	variantsByDirectory = {}
+	for filePath in releaseFiles:
+		fileName = filePath.split('/')[-1]
+		if fileName in preferedPackagesExtensions:
+			variantsByDirectory.setdefault(filePath[:len(filePath)-len(fileName)], {})[fileName] = releaseFiles[filePath]
+	remotePackagesFilePath = []
+	for index, (directory, variants) in enumerate(variantsByDirectory.items()):
+		# a local copy of the listed hash is up to date, nothing to download then
+		sizesByFileName = []
+		for fileName in preferedPackagesExtensions:
+			if fileName in variants:
+				localFileName, fileExtension = getPackagesFileName(sourceURL+directory+fileName, "{:0>3}".format(str(index)) if len(variantsByDirectory) > 1 else -1)
+				localFilePath = os.path.join(args.directory, localFileName)
+				upToDate = matchesReleaseEntry(localFilePath, variants[fileName])
+				sizesByFileName.append((fileName, 0 if upToDate else variants[fileName]['size']))
+		chosenFileName = formatSelector.choose(domainName, sizesByFileName)
+		if args.verbose and len(sizesByFileName) > 1:
+			printOutput(getAlignedLine("["+sourceContext.countPadded+"] "+domainName+" "+directory+chosenFileName+" chosen", "FOUND", GRN))
+		remotePackagesFilePath.append(directory+chosenFileName)
+	return remotePackagesFilePath
+
 # When there is no Release file, this function will trigger, tries common Packages file formats
 def crawlingForPackagesFile(url):
 	'''
-	check existence of multiple Packages files online
+	check existence of multiple Packages files online, all at the same time with HEAD requests
 	Returns a url if one found or None if nothing found
 	'''
-	global sourceCountPadded
+	sourceCountPadded = sourceContext.countPadded
 	domainName = url.split('/')[2]
+	if not url.endswith('/'): url += '/'
 
-	for file in preferedPackagesExtensions:
-		response = getResponse(url+"/"+file)
-		if response != None:
-			if args.verbose: print(getAlignedLine("["+sourceCountPadded+"] "+domainName+" "+file+" found by crawling", "FOUND", GRN))
-			url = response.geturl()
-			response.close()
-			return url
+	# every probe keeps its output, printed in the prefered order as if they were made one by one
+	def probe(file):
+		sourceContext.countPadded = sourceCountPadded
+		sourceContext.outputLines = []
+		try:
+			response = getResponse(url+file, method="HEAD")
+			foundURL = None
+			size = None
+			if response != None:
+				foundURL = response.geturl()
+				# not modified costs nothing
+				if response.status == 304:
+					size = 0
+				elif response.headers.get('Content-Length', '').isdigit():
+					size = int(response.headers['Content-Length'])
+				response.close()
+			return foundURL, size, sourceContext.outputLines
+		finally:
+			sourceContext.outputLines = None
 
-	if args.verbose: print(getAlignedLine("["+sourceCountPadded+"] "+domainName+" Packages files is NOT online", "FAILED"))
+	with ThreadPoolExecutor(max_workers=len(preferedPackagesExtensions)) as executor:
+		probes = list(executor.map(probe, preferedPackagesExtensions))
+	foundURLs = {}
+	sizesByFileName = []
+	for file, (foundURL, size, outputLines) in zip(preferedPackagesExtensions, probes):
+		for outputLine in outputLines: printOutput(outputLine)
+		if foundURL != None:
+			foundURLs[file] = foundURL
+			sizesByFileName.append((file, size))
+	# the cheapest one to download and uncompress of the found ones
+	if foundURLs:
+		file = formatSelector.choose(domainName, sizesByFileName)
+		if args.verbose: printOutput(getAlignedLine("["+sourceCountPadded+"] "+domainName+" "+file+" found by crawling", "FOUND", GRN))
+		return foundURLs[file]
+
+	if args.verbose: printOutput(getAlignedLine("["+sourceCountPadded+"] "+domainName+" Packages files is NOT online", "FAILED"))
 	return None
 
 # Get online file size
@@ -294,6 +2115,330 @@ def getURLFileSize(response):
 	else:
 		return int(response.headers['Content-Length'])
 
+# Read a Packages file in big binary chunks and split it into packages
+def parseStanzas(path, chunkSize=parseChunkSize, start=0, end=None):
+	'''
+	yields a tuple of a dictonary of all the fields of a package, its raw text as bytes and its offset in the file
+	only the part of the file between start and end is parsed if given
+	'''
+	for rawStanza, offset in splitStanzas(path, chunkSize, start, end):
+		yield parseStanza(rawStanza), rawStanza, offset
+
+# Parse a Packages file keeping only where the packages are, their text is copied from the file when it is needed
+def locateStanzas(path, start=0, end=None):
+	'''
+	yields a tuple of a dictonary of all the fields of a package, its offset and its length in the file
+	'''
+	for packageInfo, rawStanza, offset in parseStanzas(path, start=start, end=end):
+		yield packageInfo, offset, len(rawStanza)
+
+# Map a Packages file in memory to copy its packages from it by their offset and length
+def mapPackagesFile(path):
+	with open(path, 'rb') as fileObject:
+		# an empty file can NOT be mapped, and has no package to copy anyway
+		if os.fstat(fileObject.fileno()).st_size == 0:
+			return b''
+		return mmap.mmap(fileObject.fileno(), 0, access=mmap.ACCESS_READ)
+
+# Split a Packages file into the raw text of its packages
+def splitStanzas(path, chunkSize=parseChunkSize, start=0, end=None):
+	'''
+	yields a tuple of the raw text of a package as it is in the file and its offset
+	'''
+	with open(path, 'rb') as fileObject:
+		fileObject.seek(start)
+		remainder = b''
+		remainderOffset = start
+		while True:
+			if end != None:
+				chunk = fileObject.read(max(0, min(chunkSize, end-fileObject.tell())))
+			else:
+				chunk = fileObject.read(chunkSize)
+			lastChunk = not chunk
+			data = remainder+chunk
+			position = 0
+			# a separator with nothing but blanks after it may go on in the next chunk
+			contentEnd = len(data) if lastChunk else len(data.rstrip(b' \t\r\n'))
+			# splitting by a regular expression only if there are carriage returns or blank lines with spaces
+			if b'\r' in data or blankLineWithSpaces.search(data):
+				for separator in stanzaSeparator.finditer(data):
+					if separator.end() >= contentEnd and not lastChunk:
+						break
+					yield from trimStanza(data[position:separator.start()], remainderOffset+position)
+					position = separator.end()
+			else:
+				while True:
+					separatorPosition = data.find(b'\n\n', position)
+					if separatorPosition == -1 or (separatorPosition+2 >= contentEnd and not lastChunk):
+						break
+					yield from trimStanza(data[position:separatorPosition], remainderOffset+position)
+					position = separatorPosition+2
+			if lastChunk:
+				yield from trimStanza(data[position:], remainderOffset+position)
+				break
+			# the last one may continue in the next chunk
+			remainder = data[position:]
+			remainderOffset += position
+
+# Split a Packages file into parts ending between two packages
+def getStanzaRanges(path, partsCount):
+	'''
+	returns a list of tuples of the start and the end offsets of every part
+	'''
+	fileSize = os.path.getsize(path)
+	boundaries = [0]
+	with open(path, 'rb') as fileObject:
+		for partNumber in range(1, partsCount):
+			position = max(boundaries[-1], fileSize*partNumber//partsCount)
+			fileObject.seek(position)
+			data = b''
+			while True:
+				block = fileObject.read(downloadChunkSize)
+				data += block
+				separator = stanzaSeparator.search(data)
+				# a separator at the end of what is read may go on in the next block
+				if not block or (separator and separator.end() < len(data)):
+					break
+			if not separator:
+				break
+			boundaries.append(position+separator.end())
+	boundaries.append(fileSize)
+	return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+# Read the fields to index of the packages of a Packages file, with a short hash of every package text
+def getIndexRows(path, fields, start=0, end=None):
+	for packageInfo, rawStanza, offset in parseStanzas(path, start=start, end=end):
+		yield [offset, len(rawStanza), hashlib.blake2b(rawStanza, digest_size=8).hexdigest()]+[packageInfo.get(field) for field in fields]
+
+# Digest of the packages of a Packages file, to tell what changed in it
+def getPackagesDigest(packages):
+	'''
+	packages are tuples of Package, Architecture, Version, the hash of the package text and its offset
+	Returns a dictonary of every package and architecture to a tuple of its newest version, its hash and its offset
+	'''
+	digest = {}
+	for packageName, architecture, version, stanzaHash, offset in packages:
+		if packageName == None:
+			continue
+		packageKey = (packageName, architecture or "")
+		if packageKey not in digest or compareVersions(version or "", digest[packageKey][0]) > 0:
+			digest[packageKey] = (version or "", stanzaHash, offset)
+	return digest
+
+# Compare the digests of a Packages file before and after it changed
+def getPackagesChanges(packagesFile, oldDigest, newDigest):
+	'''
+	Returns a list of dictonaries of the change, added, upgraded, downgraded, changed or removed, the package, its architecture,
+	its old and new versions, its repository, and the Packages file and offset of the new package
+	'''
+	changes = []
+	for packageKey in sorted(oldDigest.keys() | newDigest.keys()):
+		oldVersion, oldHash, oldOffset = oldDigest.get(packageKey, (None, None, None))
+		newVersion, newHash, newOffset = newDigest.get(packageKey, (None, None, None))
+		if oldVersion == None:
+			change = 'added'
+		elif newVersion == None:
+			change = 'removed'
+		elif compareVersions(newVersion, oldVersion) > 0:
+			change = 'upgraded'
+		elif compareVersions(newVersion, oldVersion) < 0:
+			change = 'downgraded'
+		# the same version built again, the packages indexed without a hash can't tell
+		elif oldHash != None and oldHash != newHash:
+			change = 'changed'
+		else:
+			continue
+		changes.append({'change': change, 'package': packageKey[0], 'architecture': packageKey[1], 'oldVersion': oldVersion, 'newVersion': newVersion,
+						'repository': os.path.basename(packagesFile).split('_')[0], 'packagesFile': packagesFile, 'offset': newOffset})
+	return changes
+
+# Print how many packages the refresh changed, and save them to the changes file if asked
+def reportChanges(changes):
+	changesCounts = collections.Counter(change['change'] for change in changes)
+	if changes:
+		print("[+++] Changes: {}.".format(", ".join("{}{:>5}{} {}".format(GRN, changesCounts[change], NOC, change) for change in ['added', 'upgraded', 'downgraded', 'changed', 'removed'])))
+	if not args.changes:
+		return
+	temporaryPath = args.changes+".tmp"
+	with open(temporaryPath, "w") as fileObject:
+		if args.changes.endswith(".json"):
+			json.dump({'date': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), 'changes': [{key: value for key, value in change.items() if key != 'offset'} for change in changes]},
+					fileObject, indent="\t")
+		else:
+			for change in changes:
+				versions = change['newVersion'] if change['oldVersion'] == None else change['oldVersion'] if change['newVersion'] == None else change['oldVersion']+" -> "+change['newVersion']
+				fileObject.write("{:<11}{:<40} {:<30} {} {}\n".format(change['change'], change['package'], versions, change['architecture'], change['repository']))
+	os.replace(temporaryPath, args.changes)
+
+# Run a parsing function on a part of a Packages file, in a parse job process
+def parsePart(function, path, start, end, options):
+	return list(function(path, start=start, end=end, **options))
+
+# Remove the extra new lines around a package text
+def trimStanza(rawStanza, offset):
+	strippedStanza = rawStanza.lstrip(b'\r\n')
+	offset += len(rawStanza)-len(strippedStanza)
+	strippedStanza = strippedStanza.rstrip(b'\r\n')
+	if strippedStanza.strip():
+		yield strippedStanza, offset
+
+# Get the fields of a single package
+def parseStanza(rawStanza):
+	'''
+	returns a dictonary of all the fields, names are canonical for the known fields
+	multi-line fields keep their continuation lines as they are
+	'''
+	text = rawStanza.decode('utf-8', 'ignore')
+	if '\r' in text: text = text.replace('\r', '')
+	return {packagesFieldNames.get(name.lower(), name): value.rstrip() for name, value in stanzaFieldPattern.findall(text)}
+
+# Compare two Debian versions like dpkg
+def compareVersions(firstVersion, secondVersion):
+	'''
+	Returns a negative number if the first is older, zero if equal or a positive number if newer
+	'''
+	firstEpoch, firstUpstream, firstRevision = splitVersion(firstVersion)
+	secondEpoch, secondUpstream, secondRevision = splitVersion(secondVersion)
+	if firstEpoch != secondEpoch:
+		return firstEpoch-secondEpoch
+	return compareVersionParts(firstUpstream, secondUpstream) or compareVersionParts(firstRevision, secondRevision)
+
+# Split a version into epoch, upstream version and revision
+def splitVersion(version):
+	version = version.strip()
+	epoch = 0
+	if ':' in version:
+		epochText, version = version.split(':', 1)
+		epoch = int(epochText) if epochText.isdigit() else 0
+	if '-' in version:
+		version, revision = version.rsplit('-', 1)
+	else:
+		revision = ''
+	return epoch, version, revision
+
+# Sorting weight of a version character, tilde sorts before everything even the end
+def versionCharacterOrder(character):
+	if character.isdigit():
+		return 0
+	if character.isascii() and character.isalpha():
+		return ord(character)
+	if character == '~':
+		return -1
+	return ord(character)+256
+
+# Compare upstream versions or revisions, alternating non-digit and digit parts
+def compareVersionParts(first, second):
+	i = j = 0
+	while i < len(first) or j < len(second):
+		while (i < len(first) and not first[i].isdigit()) or (j < len(second) and not second[j].isdigit()):
+			firstOrder = versionCharacterOrder(first[i]) if i < len(first) else 0
+			secondOrder = versionCharacterOrder(second[j]) if j < len(second) else 0
+			if firstOrder != secondOrder:
+				return firstOrder-secondOrder
+			i += 1
+			j += 1
+		firstStart = i
+		while i < len(first) and first[i].isdigit(): i += 1
+		secondStart = j
+		while j < len(second) and second[j].isdigit(): j += 1
+		firstNumber = int(first[firstStart:i] or 0)
+		secondNumber = int(second[secondStart:j] or 0)
+		if firstNumber != secondNumber:
+			return 1 if firstNumber > secondNumber else -1
+	return 0
+
+# Check a version against a relation operator like >= and a version
+def versionSatisfies(version, operator, requiredVersion):
+	result = compareVersions(version, requiredVersion)
+	if operator == '<<': return result < 0
+	if operator in ['<=', '<']: return result <= 0
+	if operator == '=': return result == 0
+	if operator in ['>=', '>']: return result >= 0
+	if operator == '>>': return result > 0
+	return False
+
+# Parse a relation field like Depends: a (>= 1.0) | b, c
+def parseRelations(text):
+	'''
+	Returns a list of relations, each a list of alternatives as tuples of name, operator and version
+	operator and version are None if not versioned
+	'''
+	relations = []
+	for relationText in text.split(','):
+		relation = []
+		for alternativeText in relationText.split('|'):
+			match = relationPattern.match(alternativeText)
+			if match:
+				relation.append((match.group(1).split(':')[0], match.group(2), match.group(3)))
+		if relation:
+			relations.append(relation)
+	return relations
+
+# Format a relation back to text
+def formatRelation(relation):
+	return " | ".join(name if operator == None else "{} ({} {})".format(name, operator, version) for name, operator, version in relation)
+
+# Keep one package of every name and architecture, from the most prefered repository then the newest version
+def selectNewestPackages(packages, repoPriorities):
+	'''
+	packages are tuples of the Packages file, the offset and the fields of every package
+	repoPriorities is a dictionary of domain: priority, lower first, repositories not in it come last
+	Returns a set of the keys of the kept packages, the first one is kept if versions are equal
+	'''
+	bestPackages = {}
+	for packagesFile, offset, packageInfo in packages:
+		packageGroup = (packageInfo.get('Package'), packageInfo.get('Architecture'))
+		priority = repoPriorities.get(os.path.basename(packagesFile).split('_')[0], len(repoPriorities))
+		version = packageInfo.get('Version', '')
+		bestPackage = bestPackages.get(packageGroup)
+		if bestPackage == None or priority < bestPackage[0] or (priority == bestPackage[0] and compareVersions(version, bestPackage[1]) > 0):
+			bestPackages[packageGroup] = (priority, version, (packagesFile, offset))
+	return {bestPackage[2] for bestPackage in bestPackages.values()}
+
+# Size and checksums of the deb of a package to verify its download
+def getDebExpectations(packageInfo):
+	expected = {field: packageInfo[field] for field in DebDownloadQueue.checksumFields if field in packageInfo}
+	if packageInfo.get('Size', '').isdigit():
+		expected['Size'] = int(packageInfo['Size'])
+	return expected
+
+# Time the stanza parser against the old line by line parser over the same files
+def benchmarkParser(packagesFiles):
+	totalSize = sum(os.path.getsize(packagesFile) for packagesFile in packagesFiles)
+	print("[+++] Parsing {} Packages files of {}".format(len(packagesFiles), humanReadableLinkSpeed(totalSize, 'B')))
+
+	# the old code path, every line through extractInfo
+	startTime = time.time()
+	oldPackagesCount = 0
+	with contextlib.redirect_stdout(io.StringIO()):
+		for packagesFile in packagesFiles:
+			packageInfo = {}
+			with open(packagesFile, errors='ignore') as fileObject:
+				for lineInPackagesFile in fileObject:
+					if not lineInPackagesFile.strip():
+						if packageInfo: oldPackagesCount += 1
+						packageInfo = {}
+						continue
+					extractedValue = extractInfo(lineInPackagesFile)
+					if isinstance(extractedValue, dict):
+						packageInfo.update(extractedValue)
+					elif 'Description' in packageInfo:
+						packageInfo['Description'] += " "+extractedValue[12:]
+			if packageInfo: oldPackagesCount += 1
+	oldTime = time.time()-startTime
+
+	startTime = time.time()
+	newPackagesCount = 0
+	for packagesFile in packagesFiles:
+		for packageInfo, rawStanza, offset in parseStanzas(packagesFile):
+			newPackagesCount += 1
+	newTime = time.time()-startTime
+
+	for parserName, packagesCount, parseTime in [("line parser", oldPackagesCount, oldTime), ("stanza parser", newPackagesCount, newTime)]:
+		print("[+++] {:<14}{:>8} packages in {:>8.3f}s {:>14} {:>16}".format(parserName, packagesCount, parseTime, "{:.0f} pkg/s".format(packagesCount/max(parseTime, 0.000001)), humanReadableLinkSpeed(totalSize/max(parseTime, 0.000001))))
+	print("[+++] stanza parser is {}{:.2f}x{} faster".format(GRN, oldTime/max(newTime, 0.000001), NOC))
+
+# Old line by line parser, kept to benchmark the stanza parser against it
 # This function will trigger on every line of Packages file
 # it will extract from every line the name and the value
 def extractInfo(lineOfControlFile):
@@ -379,108 +2524,608 @@ def extractInfo(lineOfControlFile):
 def getAlignedLine(left, right, color=RED):
 	return "{4:<{0}}{2}{5:^{1}}{3}".format(leftChars, rightChars, color, NOC, left, "["+right+"]")
 
-# Here what the script is doing
+# Print a line, or keep it with the output of the source being refreshed concurrently
+# progress bar lines (end="\r") are dropped when buffering
+def printOutput(text="", end="\n"):
+	if sourceContext.outputLines is None:
+		# one write under a lock so lines of different threads don't mix
+		with outputLock:
+			sys.stdout.write(text+end)
+			sys.stdout.flush()
+	elif end == "\n":
+		sourceContext.outputLines.append(text)
 
-# Updating sources or not
-packagesFilesForAllRepos=[]
-if not args.skip_update:
-	# reading the sources file, update all
-	# initiate some variables
-	sourceCount=0
-	sourcesFileObj = open(args.sources)
-	for lineInSources in sourcesFileObj:
-		packagesFilesForThisRepo=[]
-		response=None
-		remotePackagesFilePath=[]
-		crawling=True
-		lineInSources = lineInSources.strip()
-		sourceCount+=1
-		sourceCountPadded = "{:0>3}".format(str(sourceCount))
-		lineSeparatedBySpace = lineInSources.split(' ')
-		sourceRootURL = lineSeparatedBySpace[1]
-		sourceDistribution = lineSeparatedBySpace[2]
-
-		# if there is a "component"
-		if len(lineSeparatedBySpace) > 3:
-			sourceComponent = lineSeparatedBySpace[3]
-		else:
-			sourceComponent = ""
-		
-		# Set source url by combining some structure
-		if sourceDistribution == "./" or sourceDistribution == ".":
-			sourceURL=sourceRootURL
-		else:
-			sourceURL=sourceRootURL+"dists/"+sourceDistribution+"/"
-		
-		# Get Release file
-		response = getResponse(sourceURL+"Release")
-		if response != None:
-			localFileName = downloadFile(sourceURL+"Release", response=response)
-			# Reading the downloaded Release file
+# Get the semaphore limiting the concurrent sources of a host
+def getHostSemaphore(domainName):
+	with hostSemaphoresLock:
+		if domainName not in hostSemaphores:
+			hostSemaphores[domainName] = threading.BoundedSemaphore(args.host_jobs)
+		return hostSemaphores[domainName]
+
+# Refresh a single source of the sources file
+def refreshSource(sourceCount, lineInSources):
+	'''
+	download the Release and Packages files of a source
+	Returns a list of the local Packages files of this source
+	'''
+	startTime=time.time()
+	packagesFilesForThisRepo=[]
+	response=None
+	remotePackagesFilePath=[]
+	crawling=True
+	lineInSources = lineInSources.strip()
+	sourceContext.countPadded = "{:0>3}".format(str(sourceCount))
+	lineSeparatedBySpace = lineInSources.split(' ')
+	sourceRootURL = lineSeparatedBySpace[1]
+	sourceDistribution = lineSeparatedBySpace[2]
+
+	# if there is a "component"
+	if len(lineSeparatedBySpace) > 3:
+		sourceComponent = lineSeparatedBySpace[3]
+	else:
+		sourceComponent = ""
+	
+	# Set source url by combining some structure
+	if sourceDistribution == "./" or sourceDistribution == ".":
+		sourceURL=sourceRootURL
+	else:
+		sourceURL=sourceRootURL+"dists/"+sourceDistribution+"/"
+	
+	# Get Release file
+	releaseFiles = {}
+	response = getResponse(sourceURL+"Release")
+	if response != None:
+		localFileName = downloadFile(sourceURL+"Release", response=response)
+		# Reading the downloaded Release file, every Packages file listed in it in its cheapest compression
+		if localFileName != None:
+			releaseFiles = parseReleaseFile(localFileName)
+			remotePackagesFilePath = selectPackagesFiles(sourceURL, releaseFiles)
+			if remotePackagesFilePath:
+				crawling = False
+	else:
+		# if there is no Release file, crawl for Packages file
+		crawling = True
+	
+	# Get Packages file by two methods, path if determined or by crawling
+	if crawling:
+		url = crawlingForPackagesFile(sourceURL)
+		if url != None:
+			localFileName = downloadFile(url)
 			if localFileName != None:
-				fileObject = open(localFileName, "r")
-				try:
-					for packagesFileExtension in preferedPackagesExtensions:
-						for lineInRelease in fileObject:
-							if lineInRelease.strip().endswith(packagesFileExtension):
-								remotePackagesFilePath.append(lineInRelease.split(' ')[-1].strip())
-								crawling = False
-								#raise BreakMultipleLoops
-						if not crawling: break
-						fileObject.seek(0)
-				except BreakMultipleLoops:
-					pass
-				fileObject.close()
-		else:
-			# if there is no Release file, crawl for Packages file
-			crawling = True
-		
-		# Get Packages file by two methods, path if determined or by crawling
-		if crawling:
-			url = crawlingForPackagesFile(sourceURL)
-			if url != None:
-				localFileName = downloadFile(url)
+				packagesFilesForThisRepo.append(localFileName)
+	else:
+		# if there is no Package file
+		if len(remotePackagesFilePath) < 1:
+			pass
+		elif len(remotePackagesFilePath) > 1:
+			for index, rPFP in enumerate(remotePackagesFilePath):
+				localFileName = downloadPackagesFile(sourceURL+rPFP, rPFP, releaseFiles, packagesFileNumberInFileName="{:0>3}".format(str(index)))
 				if localFileName != None:
 					packagesFilesForThisRepo.append(localFileName)
 		else:
-			# Sort and make it unique, because sometimes there are duplicates in Release file
-			remotePackagesFilePath = list(set(remotePackagesFilePath))
+			# if there is just one Package file
+			localFileName = downloadPackagesFile(sourceURL+remotePackagesFilePath[0], remotePackagesFilePath[0], releaseFiles)
+			if localFileName != None:
+				packagesFilesForThisRepo.append(localFileName)
+	metrics.addSource(sourceRootURL.split('/')[2], refreshSeconds=time.time()-startTime)
+	sourceContext.countPadded = "+++"
+	return packagesFilesForThisRepo
 
-			# if there is no Package file
-			if len(remotePackagesFilePath) < 1:
-				continue
-			elif len(remotePackagesFilePath) > 1:
-				for index, rPFP in enumerate(remotePackagesFilePath):
-					localFileName = downloadFile(sourceURL+rPFP, packagesFileNumberInFileName="{:0>3}".format(str(index)))
-					if localFileName != None:
-						packagesFilesForThisRepo.append(localFileName)
-			else:
-				# if there is just one Package file
-				localFileName = downloadFile(sourceURL+remotePackagesFilePath[0])
-				if localFileName != None:
-					packagesFilesForThisRepo.append(localFileName)
-		packagesFilesForAllRepos += packagesFilesForThisRepo
-else:
-	# if not updating the sources, get names of the existing files
-	contents = os.listdir(args.directory)
+# Refresh a source in a worker thread keeping its output for printing in order
+def refreshSourceBuffered(sourceCount, lineInSources):
+	'''
+	Returns a tuple of the source output lines and its local Packages files
+	'''
+	sourceContext.outputLines = []
+	try:
+		with getHostSemaphore(lineInSources.split('/')[2]):
+			packagesFilesForThisRepo = refreshSource(sourceCount, lineInSources)
+		return sourceContext.outputLines, packagesFilesForThisRepo
+	finally:
+		sourceContext.outputLines = None
+
+# Print the functions taking the most time, and keep all the stats for pstats or a viewer
+def printProfile(profiler):
+	profiler.disable()
+	profiler.dump_stats(os.path.join(args.directory, "profile.pstats"))
+	print("[+++] Profile of the main thread, slowest functions first:")
+	pstats.Stats(profiler, stream=sys.stdout).sort_stats('tottime').print_stats(profiledFunctions)
+
+# Print how many HTTP connections were opened and reused
+def printConnectionStats():
+	print("[+++] HTTP connections: {}{}{} opened, {}{}{} reused.".format(GRN, connectionPool.openedConnections, NOC, GRN, connectionPool.reusedConnections, NOC))
+
+# Refresh sources, in parallel if wanted, printing their output in the sources file order
+def refreshSources(linesInSources):
+	'''
+	linesInSources are tuples of the source number and its line in the sources file
+	Returns a list of the local Packages files of all the sources
+	'''
+	packagesFilesForAllRepos=[]
+	if args.jobs == 1:
+		for sourceCount, lineInSources in linesInSources:
+			packagesFilesForAllRepos += refreshSource(sourceCount, lineInSources)
+	else:
+		# submit the sources of different hosts interleaved so workers don't wait for the same host
+		sourcesByHost = {}
+		for sourceCount, lineInSources in linesInSources:
+			sourcesByHost.setdefault(lineInSources.split('/')[2], []).append((sourceCount, lineInSources))
+		submitOrder = []
+		while sourcesByHost:
+			for domainName in list(sourcesByHost):
+				submitOrder.append(sourcesByHost[domainName].pop(0))
+				if not sourcesByHost[domainName]:
+					del sourcesByHost[domainName]
+
+		with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+			futures = {sourceCount: executor.submit(refreshSourceBuffered, sourceCount, lineInSources) for sourceCount, lineInSources in submitOrder}
+			# print every source output and collect its Packages files in the sources file order
+			for sourceCount, lineInSources in linesInSources:
+				outputLines, packagesFilesForThisRepo = futures[sourceCount].result()
+				for outputLine in outputLines:
+					print(outputLine)
+				packagesFilesForAllRepos += packagesFilesForThisRepo
+	return packagesFilesForAllRepos
+
+# Local Packages files, when the sources are not updated
+def listLocalPackagesFiles():
+	'''
+	Returns a list of the local Packages files ordered like the sources file, so builds are the same as after updating
+	'''
+	packagesFilesForAllRepos=[]
+	with open(args.sources) as sourcesFileObj:
+		domainsOrder = {}
+		for lineInSources in sourcesFileObj:
+			if len(lineInSources.split('/')) > 2:
+				domainsOrder.setdefault(lineInSources.split('/')[2], len(domainsOrder))
+	contents = sorted(os.listdir(args.directory), key=lambda fileName: (domainsOrder.get(fileName.split('_')[0], len(domainsOrder)), fileName))
 	for fileName in contents:
+		if fileName == os.path.basename(scannedPackagesFile):
+			continue
 		if ("Packages" in fileName and fileName[-3:].isdigit()) or fileName.endswith("Packages"):
 			packagesFilesForAllRepos.append(os.path.join(args.directory, fileName))
+	return packagesFilesForAllRepos
+
+# Find a member of the ar archive of a deb in the first bytes of the deb
+def getDebMember(data, namePrefix):
+	'''
+	Returns a tuple of the name and the content of the first member with a name starting with namePrefix, or None if more bytes are needed
+	raises ValueError if it's not a deb
+	'''
+	if len(data) < 8:
+		return None
+	if data[:8] != b'!<arch>\n':
+		raise ValueError("is NOT a deb")
+	position = 8
+	while len(data) >= position+60:
+		memberName = bytes(data[position:position+16]).strip().rstrip(b'/')
+		memberSize = int(data[position+48:position+58])
+		if memberName.startswith(namePrefix):
+			if len(data) < position+60+memberSize:
+				return None
+			return memberName.decode('utf-8', 'replace'), bytes(data[position+60:position+60+memberSize])
+		# members start on even offsets
+		position += 60+memberSize+memberSize%2
+	return None
+
+# Read the control file of a deb and hash the whole deb, all in one read, in a parse job process
+def scanDeb(path):
+	'''
+	Returns a tuple of the control file as text, a dictonary of Size, MD5sum, SHA1 and SHA256, and an error or None
+	'''
+	hashes = {'MD5sum': hashlib.md5(), 'SHA1': hashlib.sha1(), 'SHA256': hashlib.sha256()}
+	head = bytearray()
+	controlMember = None
+	debSize = 0
+	try:
+		with open(path, 'rb') as fileObject:
+			while True:
+				block = fileObject.read(downloadChunkSize)
+				if not block:
+					break
+				for blockHash in hashes.values(): blockHash.update(block)
+				debSize += len(block)
+				# the control archive is at the start, only the bytes before its end are kept
+				if controlMember == None:
+					head += block
+					controlMember = getDebMember(head, b'control.tar')
+		if controlMember == None:
+			return None, None, "has NO control archive"
+		control = None
+		# tarfile uncompresses control.tar, control.tar.gz and control.tar.xz by itself
+		with tarfile.open(fileobj=io.BytesIO(controlMember[1])) as tarObject:
+			for member in tarObject:
+				if member.isfile() and member.name.lstrip('./') == 'control':
+					control = tarObject.extractfile(member).read()
+					break
+	except (OSError, ValueError, EOFError, tarfile.TarError, zlib.error, lzma.LZMAError) as e:
+		return None, None, str(e)
+	if control == None:
+		return None, None, "has NO control file in "+controlMember[0]
+	fileInfo = {'Size': debSize}
+	fileInfo.update({fieldName: blockHash.hexdigest() for fieldName, blockHash in hashes.items()})
+	return control.decode('utf-8', 'surrogateescape').replace('\r', '').strip('\n'), fileInfo, None
+
+# Scan a directory of debs into a Packages file in the temporary directory, like dpkg-scanpackages
+# the debs are cached by path, modification time and size, only the new or changed ones are read
+def scanDebs(directory):
+	'''
+	Returns the path of the Packages file, rewritten only if it changed
+	'''
+	cachePath = os.path.join(args.directory, "debScanCache.json")
+	cache = loadJsonFile(cachePath, {})
+
+	debsPaths = sorted(os.path.join(directoryPath, fileName) for directoryPath, directoryNames, fileNames in os.walk(directory)
+						for fileName in fileNames if fileName.endswith('.deb'))
+	scannedDebs = {}
+	debsToScan = []
+	for debPath in debsPaths:
+		debStat = os.stat(debPath)
+		entry = cache.get(os.path.abspath(debPath))
+		if entry != None and entry['size'] == debStat.st_size and entry['mtime'] == debStat.st_mtime:
+			scannedDebs[debPath] = entry
+		else:
+			debsToScan.append((debPath, debStat))
+	for (debPath, debStat), (control, fileInfo, error) in zip(debsToScan, packagesParser.map(scanDeb, [debPath for debPath, debStat in debsToScan])):
+		# a broken deb is kept too, so it's reported again only once it changes
+		if error != None:
+			printOutput(getAlignedLine("[+++] "+debPath+" "+error, "FAILED"))
+			scannedDebs[debPath] = {'size': debStat.st_size, 'mtime': debStat.st_mtime, 'error': error}
+			continue
+		scannedDebs[debPath] = {'size': debStat.st_size, 'mtime': debStat.st_mtime, 'control': control, 'fileInfo': fileInfo}
+
+	# forget the debs which aren't there anymore
+	saveJsonFile(cachePath, {os.path.abspath(debPath): entry for debPath, entry in scannedDebs.items()})
+
+	# the debs are found by their path from where the Packages file is built
+	packagesText = "".join("{}\nFilename: {}\nSize: {}\nMD5sum: {}\nSHA1: {}\nSHA256: {}\n\n".format(entry['control'], os.path.relpath(debPath).replace(os.sep, '/'),
+						entry['fileInfo']['Size'], entry['fileInfo']['MD5sum'], entry['fileInfo']['SHA1'], entry['fileInfo']['SHA256'])
+						for debPath, entry in sorted(scannedDebs.items()) if 'error' not in entry).encode('utf-8', 'surrogateescape')
+	oldPackagesText = None
+	if os.path.isfile(scannedPackagesFile):
+		with open(scannedPackagesFile, 'rb') as fileObject:
+			oldPackagesText = fileObject.read()
+	if packagesText != oldPackagesText:
+		with open(scannedPackagesFile+".part", 'wb') as fileObject:
+			fileObject.write(packagesText)
+		os.replace(scannedPackagesFile+".part", scannedPackagesFile)
+	brokenDebs = sum(1 for entry in scannedDebs.values() if 'error' in entry)
+	printOutput("[+++] Scanned {}{:>5}{} debs of {}, {}{}{} read, {}{}{} broken.".format(GRN, len(scannedDebs)-brokenDebs, NOC, directory, GRN, len(debsToScan), NOC,
+				YEL if brokenDebs else GRN, brokenDebs, NOC))
+	return scannedPackagesFile
+
+# Path of a deb in the repository served by the daemon, None if it isn't served
+def getServedFilename(packagesFile, rootURL, fileName):
+	if packagesFile == scannedPackagesFile:
+		return servedScannedDirectory+"/"+os.path.relpath(fileName, args.scan_debs).replace(os.sep, '/')
+	if not args.download or rootURL == "":
+		return None
+	# where the download queue saves it
+	debURL = rootURL+fileName
+	return "/".join([servedDebsDirectory]+([debURL.split('/')[2]] if args.store else [])+[getDebFileName(debURL)])
+
+# Find the wanted packages with their dependencies in the Packages files, then build and download them
+def processPackages(packagesFilesForAllRepos, packagesFileToBuild=None):
+	if args.store_gc:
+		collectStoreGarbage(args.store, packagesFilesForAllRepos)
+
+	# if no process specified then it's done
+	if not args.wanted and not args.download and not args.build:
+		return
+
+	# only the packages added or changed by the refresh, nothing to do if there is none and nothing to build
+	changedKeys = None
+	if args.only_changes:
+		changedKeys = {(change['packagesFile'], change['offset']) for change in packagesIndex.changes if change['change'] != 'removed'}
+		if not changedKeys and not args.build:
+			print("[+++] No package changed since the last refresh.")
+			return
+		changedFiles = {packagesFile for packagesFile, offset in changedKeys}
+
+	# if there is a wanted packages load them in a list
+	metrics.setPhase('select')
+	if args.wanted:
+		with open(args.wanted) as fileObject:
+			wantedMatcher = WantedMatcher(fileObject)
+		if packagesIndex != None:
+			# patterns are matched once for every package name of the index
+			if wantedMatcher.hasPatterns():
+				packagesIndex.setWanted([packageName for packageName in packagesIndex.getPackagesNames() if wantedMatcher.matches(packageName)])
+			else:
+				packagesIndex.setWanted(wantedMatcher.exactNames)
+
+	# add the dependencies of the wanted packages, resolved over all the Packages files
+	dependenciesKeys = set()
+	if args.with_deps:
+		if packagesIndex != None:
+			allPackages = packagesIndex.getAllPackages(packagesFilesForAllRepos, DependencyResolver.neededFields)
+		else:
+			allPackages = packagesParser.getAllPackages(packagesFilesForAllRepos)
+		dependencyResolver = DependencyResolver(allPackages)
+		wantedKeys = [packageKey for packageKey, packageInfo in dependencyResolver.packages.items() if wantedMatcher.matches(packageInfo['Package'])]
+		dependenciesKeys, unresolvedDependencies = dependencyResolver.resolve(wantedKeys)
+		if packagesIndex != None: packagesIndex.setDependencies(dependenciesKeys)
+		# every missing dependency once, with who needs it
+		packagesByUnresolvedDependency = {}
+		for packageName, dependency in unresolvedDependencies:
+			packagesByUnresolvedDependency.setdefault(dependency, []).append(packageName)
+		for dependency, packagesNames in packagesByUnresolvedDependency.items():
+			neededBy = packagesNames[0] if len(packagesNames) == 1 else "{} and {} more".format(packagesNames[0], len(packagesNames)-1)
+			print(getAlignedLine("[+++] "+dependency+" needed by "+neededBy+" is NOT found", "NOTICE", YEL))
+		print("[+++] Added {}{:>5}{} dependencies.".format(GRN, len(dependenciesKeys), NOC))
+
+	# keep only the newest version of the packages to process
+	newestKeys = None
+	if args.newest_only:
+		if packagesIndex != None:
+			allPackages = packagesIndex.getAllPackages(packagesFilesForAllRepos, ['Package', 'Version', 'Architecture'])
+		else:
+			allPackages = packagesParser.getAllPackages(packagesFilesForAllRepos)
+		if args.wanted:
+			allPackages = [(packagesFile, offset, packageInfo) for packagesFile, offset, packageInfo in allPackages
+							if wantedMatcher.matches(packageInfo.get('Package')) or (packagesFile, offset) in dependenciesKeys]
+		else:
+			allPackages = list(allPackages)
+		repoPriorities = {}
+		if args.repo_priority:
+			for domainName in args.repo_priority.split(','):
+				repoPriorities.setdefault(domainName.strip(), len(repoPriorities))
+		newestKeys = selectNewestPackages(allPackages, repoPriorities)
+		print("[+++] Skipped {}{:>5}{} older versions.".format(GRN, len(allPackages)-len(newestKeys), NOC))
+
+	# Initiates some variables
+	if args.build: packagesBuilder = PackagesBuilder(packagesFileToBuild, args.pdiffs)
+	wantedPackagesFoundWithThisSource=0
+	wantedUniquePackagesFoundWithThisSource=0
+	uniqueWantedPackages=set()
+	wantedPackagesFound=0
+	disableDownloadTemporary={'bool': False, 'value':args.download}
+	if args.download: debDownloadQueue = DebDownloadQueue(args.download_jobs, args.retries, args.limit_rate, args.store)
+
+	# Processing
+	metrics.setPhase('process')
+	if packagesIndex == None: packagesParser.prefetch(packagesFilesForAllRepos)
+	for packagesFile in packagesFilesForAllRepos:
+		if disableDownloadTemporary['bool']:
+			disableDownloadTemporary['bool']=False
+			args.download=disableDownloadTemporary['value']
+		if changedKeys != None and packagesFile not in changedFiles and not args.build:
+			continue
+
+		domainName = packagesFile.split('/')[-1].split('_')[0]
+		# rootURL from sources file
+		rootURL=""
+		with open(args.sources) as fObj:
+			for line in fObj:
+				if line.split('/')[2] == domainName:
+					rootURL = line.strip().split(' ')[1]
+					break
+
+		if rootURL == "" and args.download:
+			# the scanned debs are already here
+			if packagesFile != scannedPackagesFile: printOutput(getAlignedLine("download disabled for " + domainName, "FAILED"))
+			disableDownloadTemporary['bool']=True
+			args.download=None
+
+		# search in a single Packages file, package by package, from the index if there is
+		fileStartTime = time.time()
+		if packagesIndex != None:
+			packagesInThisFile = packagesIndex.getPackages(packagesFile, onlyWanted=bool(args.wanted))
+		else:
+			packagesInThisFile = packagesParser.parse(packagesFile)
+		stanzaMap = mapPackagesFile(packagesFile)
+		for packageInfo, offset, length in packagesInThisFile:
+			if newestKeys != None and (packagesFile, offset) not in newestKeys:
+				continue
+			# the built Packages file keeps all the packages, only the changed ones are looked for and downloaded
+			packageChanged = changedKeys == None or (packagesFile, offset) in changedKeys
+			if not packageChanged and not args.build:
+				continue
+			if args.wanted:
+				packageName = packageInfo.get('Package')
+				if not wantedMatcher.matches(packageName) and (packagesFile, offset) not in dependenciesKeys:
+					continue
+				if packageChanged:
+					wantedPackagesFoundWithThisSource+=1
+					if packageName not in uniqueWantedPackages:
+						uniqueWantedPackages.add(packageName)
+						wantedUniquePackagesFoundWithThisSource+=1
+
+			# if build copy the package to build file, all of them if nothing wanted
+			if args.build:
+				servedFilename = getServedFilename(packagesFile, rootURL, packageInfo['Filename']) if args.daemon and args.port and 'Filename' in packageInfo else None
+				with memoryview(stanzaMap) as stanzaView:
+					if servedFilename == None:
+						packagesBuilder.writeStanza(stanzaView[offset:offset+length], packageInfo.get('Architecture'))
+					else:
+						# the served debs are found where the daemon serves them
+						packagesBuilder.writeStanza(filenameFieldPattern.sub(lambda match: b"Filename: "+servedFilename.encode(), bytes(stanzaView[offset:offset+length]), count=1),
+													packageInfo.get('Architecture'))
+
+			# if download queue the deb of the package, all of them if nothing wanted
+			if args.download and packageChanged and 'Filename' in packageInfo:
+				debDownloadQueue.add(rootURL + packageInfo['Filename'], args.download, getDebExpectations(packageInfo))
+		if packagesIndex == None: metrics.addSource(domainName, parseSeconds=time.time()-fileStartTime)
+		printOutput("[+++] Found {}{:>3}{} packages in {}.".format(GRN, wantedUniquePackagesFoundWithThisSource, NOC, domainName))
+		wantedPackagesFound+=wantedPackagesFoundWithThisSource
+		wantedPackagesFoundWithThisSource=0
+		wantedUniquePackagesFoundWithThisSource=0
+
+	if disableDownloadTemporary['bool']:
+		args.download=disableDownloadTemporary['value']
+	if args.build:
+		metrics.setPhase('build')
+		packagesBuilder.close(args.release_info, args.by_hash)
+		printOutput("[+++] Built {} and its Release file.".format(packagesFileToBuild))
+	if args.download:
+		metrics.setPhase('download')
+		debDownloadQueue.wait()
+	metrics.setPhase(None)
+
+	# for i in wantedPackages:
+	# 	for j in allExtractedPackagesInfo:
+	# 		if i == j['Package']:
+	# 			print("{:50}{:10}{}".format(j['Package'], " ", j['Version']))
+	# 			continue
+
+	if args.wanted:
+		print("[+++] Found total {}{:>5}{} packages.".format(GRN, wantedPackagesFound, NOC))
+
+	if args.wanted:
+		print("[+++] Found total {}{:>5}{} unique packages.".format(GRN, len(uniqueWantedPackages), NOC))
+
+	# wanted entries which matched nothing in all the sources, unknown if only the changed packages were looked at
+	if args.wanted and (changedKeys == None or args.build):
+		unmatchedEntries = wantedMatcher.getUnmatchedEntries()
+		for entry in unmatchedEntries:
+			print(getAlignedLine("[+++] "+entry+" matched nothing", "NOTICE", YEL))
+		print("[+++] {}{:>5}{} wanted entries matched nothing.".format(YEL if unmatchedEntries else GRN, len(unmatchedEntries), NOC))
+
+# Search the indexed packages of all the sources and print the best matches
+def searchPackages(query, packagesFiles):
+	startTime = time.time()
+	matchingPackages = packagesIndex.search(query, packagesFiles, args.search_limit)
+	searchTime = time.time()-startTime
+	for row in matchingPackages:
+		domainName = os.path.basename(row['path']).split('_')[0]
+		print("{:<40} {:<20} {:<30} {}".format(row['Package'] or "", row['Version'] or "", domainName, row['Filename'] or ""))
+	print("[+++] Found {}{:>5}{} packages matching {} in {:.1f}ms.".format(GRN, len(matchingPackages), NOC, query, searchTime*1000))
+
+# Seconds until the next refresh of a source, varied so the sources don't refresh together
+def getRefreshInterval():
+	return args.interval*random.uniform(1-refreshJitter, 1+refreshJitter)
+
+# Size and modification time of a file, to know if it changed
+def getFileSignature(path):
+	try:
+		fileStat = os.stat(path)
+	except OSError:
+		return None
+	return (fileStat.st_size, fileStat.st_mtime_ns)
+
+# Keep refreshing the sources, serving the built repository, and process again when Packages files change
+def runDaemon(linesInSources, packagesFilesForAllRepos, packagesFileToBuild):
+	'''
+	every source is refreshed on its own interval, the index keeps the unchanged Packages files parsed
+	'''
+	server = None
+	if args.port:
+		# the built files and the debs, not the temporary directory nor anything else next to them
+		servedPaths = {}
+		if packagesFileToBuild:
+			buildPath = os.path.abspath(packagesFileToBuild)
+			for fileExtension in ['', '.gz', '.bz2', '.xz', '.diff']:
+				servedPaths[os.path.basename(buildPath)+fileExtension] = buildPath+fileExtension
+			servedPaths['Release'] = os.path.join(os.path.dirname(buildPath), 'Release')
+			servedPaths['by-hash'] = os.path.join(os.path.dirname(buildPath), 'by-hash')
+		if args.download: servedPaths[servedDebsDirectory] = os.path.abspath(args.download)
+		if args.scan_debs: servedPaths[servedScannedDirectory] = os.path.abspath(args.scan_debs)
+		server = http.server.ThreadingHTTPServer((args.address, args.port), functools.partial(RepoRequestHandler, servedPaths=servedPaths))
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		print("[+++] Serving {} on http://{}:{}/".format(", ".join(sorted(servedPaths)), args.address, server.server_address[1]))
+
+	# the Packages files of every source, the sources of the same domain share them until they are refreshed
+	packagesFilesBySource = {}
+	for sourceCount, lineInSources in linesInSources:
+		domainName = lineInSources.split('/')[2] if len(lineInSources.split('/')) > 2 else ""
+		packagesFilesBySource[sourceCount] = [packagesFile for packagesFile in packagesFilesForAllRepos
+											if os.path.basename(packagesFile).split('_')[0] == domainName and
+											not any(packagesFile in packagesFiles for packagesFiles in packagesFilesBySource.values())]
+	fileSignatures = {packagesFile: getFileSignature(packagesFile) for packagesFile in packagesFilesForAllRepos}
+	nextRefreshTimes = {sourceCount: time.time()+getRefreshInterval() for sourceCount, lineInSources in linesInSources}
+	linesBySource = dict(linesInSources)
+
+	try:
+		while nextRefreshTimes:
+			time.sleep(max(0, min(nextRefreshTimes.values())-time.time()))
+			metrics.setPhase('update')
+			changed = False
+			for sourceCount in sorted(nextRefreshTimes):
+				if nextRefreshTimes[sourceCount] > time.time():
+					continue
+				packagesFilesForThisRepo = refreshSources([(sourceCount, linesBySource[sourceCount])])
+				if packagesFilesForThisRepo != packagesFilesBySource[sourceCount] or \
+					any(getFileSignature(packagesFile) != fileSignatures.get(packagesFile) for packagesFile in packagesFilesForThisRepo):
+					changed = True
+				packagesFilesBySource[sourceCount] = packagesFilesForThisRepo
+				nextRefreshTimes[sourceCount] = time.time()+getRefreshInterval()
+			metadataCache.save()
+			hostHealth.save()
+			formatSelector.save()
+			if args.scan_debs:
+				scannedSignature = getFileSignature(scannedPackagesFile)
+				scanDebs(args.scan_debs)
+				changed = changed or getFileSignature(scannedPackagesFile) != scannedSignature
+			metrics.setPhase(None)
+			if not changed:
+				if args.metrics or args.prometheus: metrics.save(args.metrics, args.prometheus)
+				continue
+
+			packagesFilesForAllRepos = list(dict.fromkeys(packagesFile for sourceCount in sorted(packagesFilesBySource) for packagesFile in packagesFilesBySource[sourceCount]))
+			if args.scan_debs: packagesFilesForAllRepos.append(scannedPackagesFile)
+			fileSignatures = {packagesFile: getFileSignature(packagesFile) for packagesFile in packagesFilesForAllRepos}
+			metrics.setPhase('index')
+			if packagesIndex != None:
+				updatedPackagesFiles = packagesIndex.update(packagesFilesForAllRepos)
+				if args.verbose: printOutput(getAlignedLine("[+++] {} of {} Packages files indexed".format(len(updatedPackagesFiles), len(packagesFilesForAllRepos)), "SUCCESS", GRN))
+				reportChanges(packagesIndex.changes)
+			processPackages(packagesFilesForAllRepos, packagesFileToBuild)
+			if args.metrics or args.prometheus: metrics.save(args.metrics, args.prometheus)
+	except KeyboardInterrupt:
+		print("[+++] Daemon stopped.")
+	finally:
+		if server != None: server.shutdown()
+
+# Here what the script is doing
+
+if args.verbose: atexit.register(printConnectionStats)
+atexit.register(metadataCache.save)
+atexit.register(hostHealth.save)
+atexit.register(formatSelector.save)
+
+if args.profile:
+	profiler = cProfile.Profile()
+	profiler.enable()
+	atexit.register(printProfile, profiler)
+if args.metrics or args.prometheus:
+	atexit.register(metrics.save, args.metrics, args.prometheus)
 
-# if no process specified then exit
-if not args.wanted and not args.download and not args.build:
+# Updating sources or not
+metrics.setPhase('update')
+with open(args.sources) as sourcesFileObj:
+	linesInSources = [(sourceCount, lineInSources) for sourceCount, lineInSources in enumerate(sourcesFileObj, 1)]
+if not args.skip_update:
+	packagesFilesForAllRepos = refreshSources(linesInSources)
+else:
+	packagesFilesForAllRepos = listLocalPackagesFiles()
+if args.scan_debs:
+	packagesFilesForAllRepos.append(scanDebs(args.scan_debs))
+
+metadataCache.save()
+
+if args.benchmark_parser:
+	benchmarkParser(packagesFilesForAllRepos)
 	exit()
 
-# if there is a wanted packages load them in a list
-if args.wanted:
-	with open(args.wanted) as fileObject:
-		wantedPackages = [line.strip() for line in fileObject]
+# update the packages index for the changed Packages files
+metrics.setPhase('index')
+packagesIndex = None
+if not args.no_index:
+	packagesIndex = PackagesIndex(os.path.join(args.directory, "packagesIndex.sqlite"))
+	updatedPackagesFiles = packagesIndex.update(packagesFilesForAllRepos)
+	if args.verbose: printOutput(getAlignedLine("[+++] {} of {} Packages files indexed".format(len(updatedPackagesFiles), len(packagesFilesForAllRepos)), "SUCCESS", GRN))
+	reportChanges(packagesIndex.changes)
+
+if args.search != None:
+	searchPackages(args.search, packagesFilesForAllRepos)
+	exit()
 
 # if wanted to build Packages file, check for the existance of the Packages file
 # if exists => if verbose take the command from user else override the file
+packagesFileToBuild=None
 if args.build:
 	packagesFileToBuild='Packages'
-	if os.path.isfile(packagesFileToBuild) and args.verbose:
+	if os.path.isfile(packagesFileToBuild) and args.verbose and not args.daemon:
 		userResponse = 'UnrealisticInput:)'
 		while userResponse.lower() not in ['y', 'n', 'q']:
 			print('The file Packages already exists, Do you want to override it ? (Y/n/q): ', end='')
@@ -493,126 +3138,17 @@ if args.build:
 					packagesFileToBuild = input().strip()
 					if not os.path.isfile(packagesFileToBuild):
 						break
-	buildFileObj = open(packagesFileToBuild, 'w')
-
-# Initiates some variables
-packageName=None
-packageWanted=False
-readPackageName=True
-wantedPackagesFoundWithThisSource=0
-wantedUniquePackagesFoundWithThisSource=0
-uniqueWantedPackages=[]
-wantedPackagesFound=0
-packageInfo={}
-allExtractedPackagesInfo=[]
-disableDownloadTemporary={'bool': False, 'value':args.download}
-
-# Processing
-for packagesFile in packagesFilesForAllRepos:
-	fileObject = open(packagesFile, errors='ignore')
-
-	if disableDownloadTemporary['bool']:
-		disableDownloadTemporary['bool']=False
-		args.download=disableDownloadTemporary['value']
-
-	domainName = packagesFile.split('/')[-1].split('_')[0]
-	# rootURL from sources file
-	rootURL=""
-	fObj = open(args.sources)
-	for line in fObj:
-		if line.split('/')[2] == domainName:
-			rootURL = line.strip().split(' ')[1]
-			break
-
-	if rootURL == "" and args.download:
-		print(getAlignedLine("download disabled for " + domainName, "FAILED"))
-		disableDownloadTemporary['bool']=True
-		args.download=None
-
-	# search in a single Packages file
-	for lineInPackagesFile in fileObject:
-		# with every single line in every single Packages file
-
-		# if line is empty
-		if not packageWanted and packageInfo:
-			if packageInfo['Package'] not in uniqueWantedPackages:
-				uniqueWantedPackages.append(packageInfo['Package'])
-				wantedUniquePackagesFoundWithThisSource+=1
-			allExtractedPackagesInfo.append(packageInfo.copy())
-			packageInfo.clear()
-
-		# if line is empty be ready for new package description and skip
-		if not lineInPackagesFile.strip() and args.wanted:
-			readPackageName=True
-			# if the previous one is wanted place an empty line
-			if args.build and packageWanted: buildFileObj.write('\n')
-			packageWanted=False
-			continue
 
-		# if wanted and this is new Package
-		if args.wanted and readPackageName:
-			if lineInPackagesFile.startswith('Package:'):
-				packageName = lineInPackagesFile[8:].strip()
-				readPackageName=False
+processPackages(packagesFilesForAllRepos, packagesFileToBuild)
+metrics.setPhase(None)
 
-				if packageName in wantedPackages:
-					wantedPackagesFoundWithThisSource+=1
-					packageWanted = True
-
-		# construct a dictonary for the package
-		if packageWanted:
-			extractedValue = extractInfo(lineInPackagesFile)
-			if isinstance(extractedValue, dict):
-				packageInfo.update(extractedValue)
-			else:
-				packageInfo['Description'] += " "+extractedValue[12:]
-
-		# if build and there is nothing wanted ORRRRR if build and wanted and packageWanted then append the line to build file
-		if (args.build and not args.wanted) or (args.build and args.wanted and packageWanted):
-			buildFileObj.write(lineInPackagesFile)
-
-		# if download and the line start with Filename which is the file path
-		# this should execute for every package if wanted not specified of for only wanted
-		if args.download and lineInPackagesFile.startswith('Filename:'):
-			if args.wanted:
-				if packageWanted:
-					url = rootURL + lineInPackagesFile[9:].strip()
-					print(url)
-					print(downloadFile(url))
-			else:
-				url = rootURL + lineInPackagesFile[9:].strip()
-				print(url)
-				print(downloadFile(url))
-	print("[+++] Found {}{:>3}{} packages in {}.".format(GRN, wantedUniquePackagesFoundWithThisSource, NOC, domainName))
-	wantedPackagesFound+=wantedPackagesFoundWithThisSource
-	wantedPackagesFoundWithThisSource=0
-	wantedUniquePackagesFoundWithThisSource=0
-
-# for i in wantedPackages:
-# 	for j in allExtractedPackagesInfo:
-# 		if i == j['Package']:
-# 			print("{:50}{:10}{}".format(j['Package'], " ", j['Version']))
-# 			continue
-
-if args.wanted:
-	print("[+++] Found total {}{:>5}{} packages.".format(GRN, wantedPackagesFound, NOC))
-
-if args.wanted:
-	print("[+++] Found total {}{:>5}{} unique packages.".format(GRN, len(uniqueWantedPackages), NOC))
+if args.daemon:
+	runDaemon(linesInSources, packagesFilesForAllRepos, packagesFileToBuild)
 
 # for i in allExtractedPackagesInfo:
 # 	print(i['Package'] + "\t\t\t-\t" + i['Version'])
 
 
-# seen, result = set(), []
-# for idx, item in enumerate(allExtractedPackagesInfo):
-# 	if item['Package'] not in seen:
-# 		seen.add(item['Package'])          # First time seeing the element
-# 	else:
-# 		#print(item['Package'] +"\t\t"+ item['Version'])
-# 		result.append(item)      # Already seen, add the index to the result
-
-
 # print(allExtractedPackagesInfo)
 # [3, 4, 7, 8, 9]
 